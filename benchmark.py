@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+"""Benchmarks for tau; results are printed as JSON.
+
+Usage:
+  benchmark.py glob [--signals=<n>] [--refreshes=<n>]
+  benchmark.py ingest [--points=<n>] [--batch=<n>] [-b <backend>]...
+  benchmark.py reads [--points=<n>...] [--queries=<n>] [--window=<n>]
+                     [-b <backend>]...
+  benchmark.py server [--clients=<n>...] [--requests=<n>] [--port=<port>]
+  benchmark.py all [--queries=<n>] [--requests=<n>] [--output=<file>]
+
+Options:
+  --signals=<n>    Number of signal names [default: 1000000].
+  --refreshes=<n>  Number of dashboard refreshes [default: 5].
+  --points=<n>     Points per signal [default: 100000].
+  --batch=<n>      Points per `set_many` call [default: 1000].
+  --queries=<n>    Queries of each kind [default: 1000].
+  --window=<n>     Points in each range query [default: 1000].
+  --clients=<n>    Concurrent clients [default: 1 2 4 8].
+  --requests=<n>   Requests per client [default: 1000].
+  --port=<port>    Port of the benchmark server [default: 6289].
+  --output=<file>  Also write the results to a file.
+  -b <backend>     memory, csv, binary, compressed or glue
+                   [default: memory csv binary compressed glue].
+
+Every benchmark creates its own data in a temporary directory, from a
+generator with a fixed seed, so that results of different commits can be
+compared.
+
+"""
+import os
+import json
+import shutil
+import random
+import tempfile
+import threading
+import subprocess
+from time import time
+from datetime import datetime, timedelta
+from fnmatch import fnmatchcase
+
+from docopt import docopt
+
+from tau import Tau, Backend, TauServer, ServerBackend
+from tau import MemoryBackend, CSVBackend, BinaryBackend, CompressedBackend
+from tau import GlueBackend
+
+
+class CatalogBackend(Backend):
+
+    """Backend that only knows the names of its signals, which never change.
+
+    Like a real backend, it returns a new list every time.
+
+    """
+
+    def __init__(self, signals):
+        self._signals = signals
+
+    def signals(self):
+        return list(self._signals)
+
+    def generation(self):
+        return 0
+
+
+def signal_names(n):
+    metrics = ['cpu.user', 'cpu.system', 'mem.free', 'mem.used', 'disk.io',
+               'net.rx', 'net.tx', 'load1', 'load5', 'load15']
+    return ['host%d.%s' % (i // len(metrics), metrics[i % len(metrics)])
+            for i in range(n)]
+
+
+START = datetime(2020, 1, 1)
+STEP = timedelta(seconds=1)
+
+
+def synthetic(signal, n, seed=0):
+    """Yield `n` points of a random walk, one every `STEP` from `START`."""
+    rng = random.Random(seed)
+    value = 0.0
+    for i in xrange(n):
+        value += rng.gauss(0, 1)
+        yield signal, START + i * STEP, round(value, 2)
+
+
+def backend(name, path):
+    """Make a backend by its command-line name, storing files in `path`."""
+    memory = lambda: MemoryBackend(cache_seconds=10 ** 9)  # keep it all
+    return {'memory': memory,
+            'csv': lambda: CSVBackend(path),
+            'binary': lambda: BinaryBackend(path),
+            'compressed': lambda: CompressedBackend(path),
+            'glue': lambda: GlueBackend(memory(), BinaryBackend(path)),
+            }[name]()
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    at = lambda p: latencies[min(len(latencies) - 1,
+                                 int(p / 100.0 * len(latencies)))]
+    return {'p50': at(50), 'p90': at(90), 'p99': at(99),
+            'max': latencies[-1]}
+
+
+def timed(function, repeat):
+    started = time()
+    for _ in range(repeat):
+        function()
+    return (time() - started) / repeat
+
+
+def fill(b, n, batch):
+    """Store `n` synthetic points in batches; return the seconds it took."""
+    points = synthetic('foo', n)
+    started = time()
+    while True:
+        chunk = [p for _, p in zip(xrange(batch), points)]
+        if not chunk:
+            break
+        b.set_many(chunk)
+    return time() - started
+
+
+def glob(signals, refreshes):
+    """Time dashboard refreshes that each match 100 host patterns."""
+    names = signal_names(signals)
+    patterns = ['host%d.cpu.*' % i for i in range(0, 100 * 97, 97)]
+    tau = Tau(CatalogBackend(names))
+    started = time()
+    tau._matching_signals(*patterns)
+    cold = time() - started
+    return {'benchmark': 'glob',
+            'signals': signals,
+            'patterns': len(patterns),
+            'fnmatch_seconds': timed(lambda: set(
+                s for p in patterns for s in names if fnmatchcase(s, p)), 1),
+            'index_cold_seconds': cold,
+            'index_seconds': timed(lambda: tau._matching_signals(*patterns),
+                                   refreshes)}
+
+
+def ingest(names, n, batch):
+    """Measure how many points per second each backend stores."""
+    results = []
+    for name in names:
+        path = tempfile.mkdtemp() + '/'
+        try:
+            seconds = fill(backend(name, path), n, batch)
+        finally:
+            shutil.rmtree(path)
+        results.append({'benchmark': 'ingest', 'backend': name,
+                        'points': n, 'batch': batch,
+                        'points_per_second': n / seconds})
+    return results
+
+
+def reads(names, sizes, queries, window):
+    """Measure latest and range query latencies as the signal grows."""
+    results = []
+    rng = random.Random(0)
+    for name in names:
+        for n in sizes:
+            path = tempfile.mkdtemp() + '/'
+            try:
+                b = backend(name, path)
+                fill(b, n, 10000)
+                latest, ranges = [], []
+                for _ in range(queries):
+                    started = time()
+                    b.get('foo')
+                    latest.append(time() - started)
+                    first = rng.randrange(max(n - window, 1))
+                    start = START + first * STEP
+                    end = start + (window - 1) * STEP
+                    started = time()
+                    b.get('foo', start, end)
+                    ranges.append(time() - started)
+            finally:
+                shutil.rmtree(path)
+            results.append({'benchmark': 'reads', 'backend': name,
+                            'points': n, 'window': window,
+                            'latest_seconds': percentiles(latest),
+                            'range_seconds': percentiles(ranges)})
+    return results
+
+
+def server(clients, requests, port):
+    """Measure requests per second of one server as clients are added.
+
+    Half of the requests are `set`s, which get no reply, so each client
+    ends with a `signals` to time them until the server has run them;
+    latencies are those of the `get`s.
+
+    """
+    memory = MemoryBackend(cache_seconds=10 ** 9)
+    fill(memory, 10000, 10000)
+    tau = TauServer(memory, port=port)
+    thread = threading.Thread(target=tau.serve_forever)
+    thread.daemon = True
+    thread.start()
+    results = []
+    try:
+        for n in clients:
+            backends = [ServerBackend(port=port) for _ in range(n)]
+            latencies = []
+
+            def work(b):
+                for i in range(requests):
+                    if i % 2:
+                        b.set('bar', datetime.now(), i)
+                        continue
+                    started = time()
+                    b.get('foo', START, START + 99 * STEP)
+                    latencies.append(time() - started)
+                b.signals()
+
+            threads = [threading.Thread(target=work, args=(b,))
+                       for b in backends]
+            started = time()
+            [t.start() for t in threads]
+            [t.join() for t in threads]
+            seconds = time() - started
+            [b.close() for b in backends]
+            results.append({'benchmark': 'server', 'clients': n,
+                            'requests': n * requests,
+                            'requests_per_second': n * requests / seconds,
+                            'latency_seconds': percentiles(latencies)})
+    finally:
+        tau.shutdown()
+        thread.join()
+    return results
+
+
+def commit():
+    """Current git commit, to tell apart the results of different trees."""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    names = args['-b']
+    sizes = [int(n) for a in args['--points'] for n in a.split()]
+    clients = [int(n) for a in args['--clients'] for n in a.split()]
+    if args['glob']:
+        result = glob(int(args['--signals']), int(args['--refreshes']))
+    elif args['ingest']:
+        result = ingest(names, sizes[0], int(args['--batch']))
+    elif args['reads']:
+        result = reads(names, sizes, int(args['--queries']),
+                       int(args['--window']))
+    elif args['server']:
+        result = server(clients, int(args['--requests']),
+                        int(args['--port']))
+    elif args['all']:
+        result = (ingest(names, sizes[0], int(args['--batch'])) +
+                  reads(names, [10 ** 3, 10 ** 5], int(args['--queries']),
+                        int(args['--window'])) +
+                  server(clients, int(args['--requests']),
+                         int(args['--port'])))
+    result = {'commit': commit(), 'time': datetime.now().isoformat(),
+              'results': result}
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True)
+    print(json.dumps(result, indent=4, sort_keys=True))
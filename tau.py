@@ -11,100 +11,820 @@
 
 Usage:
   tau (-h | --help | --version)
-  tau server (-b <backend>)...
-  tau set <key=value>... [-b <backend>]...
+  tau server (-b <backend>)... [--port=<port>] [--profile=<n>]
+              [--cache=<points>] [--enums]
+  tau set <key=value>... [-b <backend>]... [--enums]
   tau get <key>... [--period=<seconds> | --start=<date> --end=<date>]
+          [--bucket=<seconds>] [--aggregate=<function>]
           [--timestamps] [-b <backend>]...
   tau signals [-b <backend>]...
   tau clear [-b <backend>]...
+  tau stats [--port=<port>]
 
 Options:
   -b <backend>
+  --port=<port>           Port of the server [default: 6283].
+  --aggregate=<function>  min, max, mean, sum, count, first or last.
+  --profile=<n>           Profile every n-th command with cProfile.
+  --cache=<points>        Cache range queries, up to so many points.
+  --enums                 Store strings in the binary backend as codes.
 
 """
 import socket
 import os
 import sys
+import select
+import threading
 import traceback
 import json
+import mmap
+import re
+import shutil
+import cProfile
+import pstats
+import _strptime  # imported lazily by strptime, which is not thread-safe
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from itertools import islice, chain
+from hashlib import md5
 from struct import Struct
-from fnmatch import fnmatchcase
+from fnmatch import translate
+from time import sleep, time
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from Queue import Queue, LifoQueue, Empty, Full
+from StringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 from docopt import docopt
 
+try:
+    import numpy
+except ImportError:  # only needed for `as_arrays`
+    numpy = None
+
+
+def _parse_datetime(text):
+    """Parse `datetime.isoformat()`, which omits zero microseconds."""
+    if '.' in text:
+        return datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(text, '%Y-%m-%dT%H:%M:%S')
+
 
 class TauProtocol(object):
 
-    """JSON-based protocol for communication over TCP."""
+    """JSON-based protocol for communication over TCP.
+
+    Messages are newline-terminated, so any number of them can be sent
+    over one connection, including several at once (pipelining).
+
+    """
+
+    columns = False  # see `BinaryProtocol`; JSON has no columns to keep
 
     def __init__(self, host='localhost', port=6283, client=None):
         self._host = host
         self._port = port
         self._client = client
+        self._chunks = []
+        self._messages = deque()
+        self.sent = 0  # bytes
 
     def __enter__(self):
+        return self.connect()
+
+    def connect(self):
         if not self._client:
             self._client = socket.socket()
+            self._client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self._client.connect((self._host, self._port))
         return self
 
+    @property
+    def socket(self):
+        return self._client
+
     def send(self, message):
+        self.send_many([message])
+
+    def send_many(self, messages):
         def encode_datetime(obj):
             if type(obj) is datetime:
                 return {'__datetime__': obj.isoformat()}
             raise TypeError("%r is not JSON serializable" % obj)
         #assert '\n' not in json.dumps(message)
-        self._client.send(json.dumps(message, default=encode_datetime) + '\n')
+        data = ''.join(json.dumps(m, default=encode_datetime) + '\n'
+                       for m in messages)
+        self._client.sendall(data)
+        self.sent += len(data)
 
-    def receive(self):
+    def feed(self, data):
+        """Buffer received `data` and return the messages it completes."""
         def decode_datetime(obj):
             if '__datetime__' in obj:
-                return datetime.strptime(obj['__datetime__'],
-                                         '%Y-%m-%dT%H:%M:%S.%f')
+                return _parse_datetime(obj['__datetime__'])
             return obj
-        message = ''
-        while True:
-            message += self._client.recv(4096)
-            if message.endswith('\n'):  # or message == '':
-                break
-        return json.loads(message, object_hook=decode_datetime)
+        if '\n' not in data:
+            self._chunks.append(data)
+            return []
+        lines = (''.join(self._chunks) + data).split('\n')
+        self._chunks = [lines.pop()]
+        return [json.loads(line, object_hook=decode_datetime)
+                for line in lines]
 
-    def __exit__(self, exception_type, value, traceback):
+    def receive(self):
+        """Receive one message; raise `EOFError` if the peer hung up."""
+        while not self._messages:
+            data = self._client.recv(65536)
+            if not data:
+                raise EOFError('connection closed')
+            self._messages.extend(self.feed(data))
+        return self._messages.popleft()
+
+    def idle(self):
+        """Check that nothing (such as a hang-up) is waiting to be read."""
+        try:
+            return (not self._buffered() and
+                    not select.select([self._client], [], [], 0)[0])
+        except (socket.error, ValueError):
+            return False
+
+    def _buffered(self):
+        return bool(self._messages or any(self._chunks))
+
+    def close(self):
         #self._client.shutdown(socket.SHUT_RDWR)
         self._client.close()
 
+    def __exit__(self, exception_type, value, traceback):
+        self.close()
+
+
+_INT64 = Struct('<q')
+_FLOAT64 = Struct('<d')
+_FLOAT32 = Struct('<f')
+_LENGTH = Struct('<I')
+
+
+def _is_series(obj):
+    """Check if `obj` is a list of `[datetime, float]` points."""
+    return bool(obj) and all(isinstance(p, list) and len(p) == 2 and
+                             type(p[0]) is datetime and type(p[1]) is float
+                             for p in obj)
+
+
+def _pack(obj, parts):
+    """Append the binary encoding of `obj` to the list of string `parts`."""
+    if obj is None:
+        parts.append('n')
+    elif isinstance(obj, bool):
+        parts.append('t' if obj else 'f')
+    elif isinstance(obj, (int, long)) and -2 ** 63 <= obj < 2 ** 63:
+        parts.append('i' + _INT64.pack(obj))
+    elif isinstance(obj, (int, long)):
+        parts.append('I')
+        _pack(str(obj), parts)
+    elif isinstance(obj, float):
+        parts.append('d' + _FLOAT64.pack(obj))
+    elif isinstance(obj, datetime):
+        parts.append('D' + _INT64.pack(_to_ticks(obj)))
+    elif isinstance(obj, basestring):
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        parts.extend(['s', _LENGTH.pack(len(obj)), obj])
+    elif isinstance(obj, list) and _is_series(obj):
+        n = len(obj)
+        parts.extend(['S', _LENGTH.pack(n),
+                      Struct('<%dq' % n).pack(*[_to_ticks(t) for t, _ in obj]),
+                      Struct('<%dd' % n).pack(*[v for _, v in obj])])
+    elif isinstance(obj, (list, tuple)):
+        parts.extend(['l', _LENGTH.pack(len(obj))])
+        for item in obj:
+            _pack(item, parts)
+    elif isinstance(obj, dict):
+        parts.extend(['m', _LENGTH.pack(len(obj))])
+        for key, value in obj.items():
+            _pack(key, parts)
+            _pack(value, parts)
+    else:
+        raise TypeError("%r is not serializable" % obj)
+
+
+def _unpack(data, offset, columns=False):
+    """Decode the object at `offset` of bytearray `data`.
+
+    Returns the object and the offset just past it. Packed columns are
+    decoded straight out of `data`, without copying them first; with
+    `columns`, into a `(ticks, values)` pair of NumPy arrays, without
+    making an object of each point.
+
+    """
+    tag = chr(data[offset])
+    offset += 1
+    if tag == 'n':
+        return None, offset
+    elif tag in 'tf':
+        return tag == 't', offset
+    elif tag == 'i':
+        return _INT64.unpack_from(data, offset)[0], offset + 8
+    elif tag == 'I':
+        digits, offset = _unpack(data, offset, columns)
+        return int(digits), offset
+    elif tag == 'd':
+        return _FLOAT64.unpack_from(data, offset)[0], offset + 8
+    elif tag == 'D':
+        return _to_date(_INT64.unpack_from(data, offset)[0]), offset + 8
+    elif tag == 's':
+        n = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        return data[offset:offset + n].decode('utf-8'), offset + n
+    elif tag == 'S':
+        n = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        if columns:
+            return ((numpy.frombuffer(data, '<i8', n, offset)
+                     .astype(numpy.int64),
+                     numpy.frombuffer(data, '<f8', n, offset + 8 * n)
+                     .astype(numpy.float64)),
+                    offset + 16 * n)
+        ticks = Struct('<%dq' % n).unpack_from(data, offset)
+        values = Struct('<%dd' % n).unpack_from(data, offset + 8 * n)
+        return ([[_to_date(t), v] for t, v in zip(ticks, values)],
+                offset + 16 * n)
+    elif tag == 'l':
+        n = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        result = []
+        for _ in range(n):
+            item, offset = _unpack(data, offset, columns)
+            result.append(item)
+        return result, offset
+    elif tag == 'm':
+        n = _LENGTH.unpack_from(data, offset)[0]
+        offset += 4
+        result = {}
+        for _ in range(n):
+            key, offset = _unpack(data, offset, columns)
+            result[key], offset = _unpack(data, offset, columns)
+        return result, offset
+    raise ValueError('unknown tag %r' % tag)
+
+
+class BinaryProtocol(TauProtocol):
+
+    """Length-prefixed binary protocol for communication over TCP.
+
+    A client asks for it with a JSON `hello` command right after
+    connecting, and the server agrees by replying 'binary' (a server that
+    does not know the command just hangs up). After that every message is a
+    4-byte length followed by a tagged binary encoding, in which
+    datetimes travel as int64 ticks and lists of `[datetime, float]`
+    points as packed int64 and float64 columns. Unless `columns` is
+    false, these are received as NumPy arrays rather than as points.
+
+    """
+
+    hello = ['hello', 'binary']
+
+    def __init__(self, host='localhost', port=6283, client=None,
+                 timeout=1):
+        TauProtocol.__init__(self, host, port, client)
+        self._buffer = bytearray()
+        self._timeout = timeout
+
+    def connect(self):
+        """Connect and negotiate; raise `EOFError` if the server refuses.
+
+        Only a server that hangs up or replies something else refuses;
+        other errors, such as a timeout, are raised as they are.
+
+        """
+        if not self._client:
+            protocol = TauProtocol(self._host, self._port).connect()
+            try:
+                protocol.socket.settimeout(self._timeout)
+                protocol.send(self.hello)
+                reply = protocol.receive()
+                protocol.socket.settimeout(None)
+            except EOFError:
+                reply = None
+            except Exception:
+                protocol.close()
+                raise
+            if reply != self.hello[1]:
+                protocol.close()
+                raise EOFError('server does not speak the binary protocol')
+            self._client = protocol.socket
+        return self
+
+    def send_many(self, messages):
+        parts = []
+        for message in messages:
+            body = []
+            _pack(message, body)
+            parts.append(_LENGTH.pack(sum(len(p) for p in body)))
+            parts.extend(body)
+        data = ''.join(parts)
+        self._client.sendall(data)
+        self.sent += len(data)
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        messages = []
+        offset = 0
+        while len(self._buffer) - offset >= 4:
+            n = _LENGTH.unpack_from(self._buffer, offset)[0]
+            if len(self._buffer) - offset - 4 < n:
+                break
+            messages.append(_unpack(self._buffer, offset + 4,
+                                    self.columns)[0])
+            offset += 4 + n
+        del self._buffer[:offset]
+        return messages
+
+    def _buffered(self):
+        return bool(self._messages or self._buffer)
+
+
+class _KeyLocks(object):
+
+    """Per-signal locks, so that writes to different signals can overlap."""
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def __call__(self, keys):
+        with self._lock:
+            locks = [self._locks.setdefault(k, threading.Lock())
+                     for k in sorted(set(keys))]
+        self._acquire(locks)
+        try:
+            yield
+        finally:
+            self._release(locks)
+
+    @contextmanager
+    def all(self):
+        """Hold every lock, and keep new ones from being handed out."""
+        with self._lock:
+            locks = [self._locks[k] for k in sorted(self._locks)]
+            self._acquire(locks)
+            try:
+                yield
+            finally:
+                self._release(locks)
+
+    @staticmethod
+    def _acquire(locks):
+        for lock in locks:
+            lock.acquire()
+
+    @staticmethod
+    def _release(locks):
+        for lock in reversed(locks):
+            lock.release()
+
+
+class _Connection(object):
+
+    """Client connection together with the commands waiting to be run."""
+
+    def __init__(self, client):
+        self.protocol = TauProtocol(client=client)
+        self.fresh = True
+        self.pending = deque()
+        self.busy = False
+        self.closed = False
+
+
+class _Subscription(object):
+
+    """Signals a connection subscribed to, and the points not yet pushed."""
+
+    def __init__(self, protocol, patterns, max_rate):
+        self.protocol = protocol
+        self.patterns = patterns
+        self.interval = 1.0 / max_rate if max_rate else 0
+        self.pending = {}
+        self.due = float('inf')  # until the latest points are sent
+
+    def matches(self, signal):
+        return any(_SignalIndex._compile(p)(signal) for p in self.patterns)
+
+
+class Metrics(object):
+
+    """Counters and latency histograms of a server and its backends.
+
+    Latencies are counted in buckets whose upper bounds are powers of two
+    microseconds, so recording a command costs one lock and a handful of
+    increments. With `profile_every`, every so many commands run under
+    cProfile, and the reports of the latest `profiles` of them are kept.
+
+    """
+
+    def __init__(self, profile_every=None, profiles=10):
+        self._profile_every = profile_every
+        self._profiles = deque(maxlen=profiles)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._commands = {}
+            self._points = {}
+            self._received = 0
+            self._calls = 0
+            self._started = time()
+            self._profiles.clear()
+
+    def received(self, size):
+        with self._lock:
+            self._received += size
+
+    def command(self, command, seconds, sent, failed=False):
+        bucket = 1 << int(seconds * 1000000).bit_length()
+        with self._lock:
+            if command not in self._commands:
+                self._commands[command] = {'count': 0, 'errors': 0,
+                                           'seconds': 0.0, 'max_seconds': 0,
+                                           'bytes_out': 0, 'histogram': {}}
+            stats = self._commands[command]
+            stats['count'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes_out'] += sent
+            stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+
+    def points(self, backend, scanned, returned):
+        """Count the points a backend read to return `returned` of them."""
+        with self._lock:
+            if backend not in self._points:
+                self._points[backend] = {'reads': 0, 'scanned': 0,
+                                         'returned': 0}
+            stats = self._points[backend]
+            stats['reads'] += 1
+            stats['scanned'] += scanned
+            stats['returned'] += returned
+
+    def profiled(self, name, function, *arguments):
+        """Call `function`, under cProfile if it is its turn to be sampled."""
+        with self._lock:
+            self._calls += 1
+            sampled = (self._profile_every and
+                       self._calls % self._profile_every == 0)
+        if not sampled:
+            return function(*arguments)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *arguments)
+        finally:
+            report = StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats(
+                    'cumulative').print_stats(20)
+            with self._lock:
+                self._profiles.append({'command': name,
+                                       'report': report.getvalue()})
+
+    def snapshot(self):
+        """All the metrics as a JSON-friendly dict."""
+        with self._lock:
+            commands = {}
+            for command, stats in self._commands.items():
+                stats = dict(stats,
+                             histogram=sorted(stats['histogram'].items()))
+                stats['mean_seconds'] = stats.pop('seconds') / stats['count']
+                commands[command] = stats
+            return {'uptime_seconds': time() - self._started,
+                    'bytes_in': self._received,
+                    'bytes_out': sum(c['bytes_out']
+                                     for c in commands.values()),
+                    'commands': commands,
+                    'backends': dict((b, dict(p))
+                                     for b, p in self._points.items()),
+                    'profiles': list(self._profiles)}
+
+
+def _wrapped(value, seen):
+    """Backends in `value`, which may be lists and tuples of them, and those
+    they wrap, each one once."""
+    if isinstance(value, Backend):
+        if id(value) in seen:
+            return []
+        seen.add(id(value))
+        return [value] + _wrapped(vars(value).values(), seen)
+    if isinstance(value, (list, tuple)):
+        return [b for item in value for b in _wrapped(item, seen)]
+    return []
+
+
+def _instrument(backend, metrics):
+    """Make `backend`, and the backends it wraps, report to `metrics`.
+
+    Backends that already report to other metrics, such as those of
+    another server, are left to them. Returns the backends instrumented.
+
+    """
+    instrumented = [b for b in _wrapped(backend, set()) if b.metrics is None]
+    for b in instrumented:
+        b.metrics = metrics
+    return instrumented
+
 
 class TauServer(object):
 
     """Server that runs queries on a given backend."""
 
-    def __init__(self, backend, host='localhost', port=6283, cache_seconds=1):
+    chunk_size = 10000  # points in each message of an `iter_range` reply
+
+    def __init__(self, backend, host='localhost', port=6283, cache_seconds=1,
+                 workers=8, metrics=True, profile_every=None,
+                 cache_points=None):
+        """Serve `backend` on `host` and `port`.
+
+        One thread polls the connections, and `workers` threads run their
+        commands: those of one connection one at a time and in order,
+        those of different connections concurrently.
+
+        Unless `metrics` is false, commands and the points read by backends
+        are counted in `self.metrics`, which the `stats` command returns;
+        `profile_every` is passed on to `Metrics`. With `cache_points`,
+        range queries go through a `CachedBackend` of that size.
+
+        """
+        if cache_points:
+            backend = CachedBackend(backend, cache_points)
         self.backend = backend
+        self.metrics = Metrics(profile_every) if metrics else None
+        self._instrumented = (_instrument(backend, self.metrics)
+                              if self.metrics else [])
         self.server = socket.socket()
         #self.server.bind((socket.gethostname(), port))
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((host, port))
-        self.server.listen(5)
-        while True:
+        self.server.listen(128)
+        self._workers = workers
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._locks = _KeyLocks()
+        self._running = True
+        self._subscriptions = {}
+        self._watchers = {}
+        self._pushes = threading.Condition()
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+    def serve_forever(self):
+        with self._pushes:
+            if not self._running:
+                return
+            self._stopped.clear()
+        workers = [threading.Thread(target=self._work)
+                   for _ in range(self._workers)]
+        workers.append(threading.Thread(target=self._push))
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        poll = select.poll()
+        poll.register(self.server, select.POLLIN)
+        connections = {}
+        while self._running:
+            for fd, event in poll.poll(100):
+                if fd == self.server.fileno():
+                    client, address = self.server.accept()
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                      1)
+                    connections[client.fileno()] = _Connection(client)
+                    poll.register(client, select.POLLIN)
+                elif not self._read(connections[fd]):
+                    poll.unregister(fd)
+                    del connections[fd]
+        for worker in workers:
+            self._queue.put(None)
+        for connection in connections.values():
+            self._abort(connection)  # so that no worker waits on a client
+            self._hang_up(connection)
+        for worker in workers:
+            worker.join()
+        self.server.close()
+        self._stopped.set()
+
+    def shutdown(self):
+        """Stop serving, and wait for the commands being run to finish."""
+        with self._pushes:
+            self._running = False
+            self._pushes.notify()
+        self._stopped.wait()
+        for backend in self._instrumented:
+            backend.metrics = None
+
+    def _read(self, connection):
+        """Queue the commands read from a connection; False on hang-up."""
+        try:
+            data = connection.protocol.socket.recv(65536)
+            messages = connection.protocol.feed(data) if data else None
+            if messages and connection.fresh:
+                connection.fresh = False
+                if messages[0] == BinaryProtocol.hello:
+                    connection.protocol.send(BinaryProtocol.hello[1])
+                    connection.protocol = BinaryProtocol(client=connection
+                                                         .protocol.socket)
+                    messages.pop(0)
+            if data and self.metrics:
+                self.metrics.received(len(data))
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            data = messages = None
+        if not data or messages is None:
+            self._hang_up(connection)
+            return False
+        with self._lock:
+            connection.pending.extend(messages)
+            if connection.pending and not connection.busy:
+                connection.busy = True
+                self._queue.put(connection)
+        return True
+
+    def _hang_up(self, connection):
+        self._unsubscribe(connection)
+        with self._lock:
+            connection.closed = True
+            connection.pending.clear()
+            if not connection.busy:
+                connection.protocol.close()
+
+    def _work(self):
+        for connection in iter(self._queue.get, None):
+            while True:
+                with self._lock:
+                    if not connection.pending:
+                        connection.busy = False
+                        if connection.closed:
+                            connection.protocol.close()
+                        break
+                    message = connection.pending.popleft()
+                try:
+                    command, arguments = message
+                    self._run(connection.protocol, command, arguments)
+                except socket.error:
+                    self._abort(connection)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+                    self._abort(connection)
+
+    def _abort(self, connection):
+        """Drop the rest of the commands and let the poller see a hang-up."""
+        self._unsubscribe(connection)
+        with self._lock:
+            connection.pending.clear()
+        try:
+            connection.protocol.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _run(self, protocol, command, arguments):
+        if not self.metrics:
+            return self._handle(protocol, command, arguments)
+        sent, started, failed = protocol.sent, time(), True
+        try:
+            self.metrics.profiled(command, self._handle, protocol, command,
+                                  arguments)
+            failed = False
+        finally:
+            self.metrics.command(command, time() - started,
+                                 protocol.sent - sent, failed)
+
+    def _handle(self, protocol, command, arguments):
+        if command == 'get':
             try:
-                client, address = self.server.accept()
-                with TauProtocol(client=client) as protocol:
-                    command, arguments = protocol.receive()
-                    if command == 'get':
-                        try:
-                            protocol.send(self.backend.get(*arguments))
-                        except BackendError:
-                            protocol.send([])  # maybe better ['error', 'msg]
-                    elif command == 'set':
-                        self.backend.set(*arguments)
-                    elif command == 'signals':
-                        protocol.send(self.backend.signals())
-                    elif command == 'clear':
-                        self.backend.clear()
-            except Exception:
+                protocol.send(self.backend.get(*arguments))
+            except BackendError:
+                protocol.send([])  # maybe better ['error', 'msg]
+        elif command == 'get_many':
+            protocol.send(self.backend.get_many(*arguments))
+        elif command == 'iter_range':
+            chunk = []
+            try:
+                for point in self.backend.iter_range(*arguments):
+                    chunk.append(point)
+                    if len(chunk) == self.chunk_size:
+                        protocol.send(chunk)
+                        chunk = []
+            except BackendError as error:
+                end = {'error': str(error)}  # for the client to raise
+            else:
+                end = []  # end of stream
+            if chunk:
+                protocol.send(chunk)
+            protocol.send(end)
+        elif command == 'aggregate':
+            try:
+                protocol.send(self.backend.aggregate(*arguments))
+            except BackendError:
+                protocol.send([])
+        elif command in ('set', 'set_many', 'clear'):
+            try:
+                self._write(command, arguments)
+            except BackendError:  # no reply is owed, so just log it
                 traceback.print_exc(file=sys.stderr)
-        self.server.close()
+        elif command == 'signals':
+            protocol.send(self.backend.signals())
+        elif command == 'stats':
+            protocol.send(self.metrics and self.metrics.snapshot())
+        elif command == 'subscribe':
+            self._subscribe(protocol, *arguments)
+
+    def _write(self, command, arguments):
+        """Writes are serialized per signal; reads take no locks at all."""
+        if command == 'set':
+            with self._locks([arguments[0]]):
+                self.backend.set(*arguments)
+            self._notify([arguments])
+        elif command == 'set_many':
+            with self._locks(key for key, _, _ in arguments):
+                self.backend.set_many(arguments)
+            self._notify(arguments)
+        elif command == 'clear':
+            with self._locks.all():
+                self.backend.clear()
+
+    def _subscribe(self, protocol, patterns, max_rate):
+        """Push the latest points of matching signals as they are set.
+
+        Pushes are sent at most `max_rate` times a second by a thread of
+        their own, so writers never wait for them. They share the socket
+        with replies, so a subscribed connection must send no more
+        commands, as `ServerBackend.subscribe` makes sure.
+
+        """
+        subscription = _Subscription(protocol, patterns, max_rate)
+        with self._pushes:
+            self._subscriptions[protocol] = subscription
+            self._watchers = {}
+        index = _SignalIndex(self.backend.signals())
+        latest = self.backend.get_many(set(s for p in patterns
+                                           for s in index.match(p)))
+        protocol.send(dict((s, points[-1])
+                           for s, points in latest.items() if points))
+        with self._pushes:
+            subscription.due = time() + subscription.interval
+            self._pushes.notify()
+
+    def _unsubscribe(self, connection):
+        with self._pushes:
+            if self._subscriptions.pop(connection.protocol, None):
+                self._watchers = {}
+
+    def _notify(self, points):
+        """Queue points for the subscriptions that watch their signals.
+
+        Which subscriptions watch a signal is remembered, so setting one
+        that nobody watches costs a single lookup.
+
+        """
+        if not self._subscriptions:
+            return
+        with self._pushes:
+            for key, time, value in points:
+                if key not in self._watchers:
+                    self._watchers[key] = [
+                        s for s in self._subscriptions.values()
+                        if s.matches(key)]
+                for subscription in self._watchers[key]:
+                    subscription.pending[key] = [time, value]
+            self._pushes.notify()
+
+    def _push(self):
+        """Send the pending points of every subscription that is due."""
+        while True:
+            with self._pushes:
+                if not self._running:
+                    return
+                now = time()
+                waiting = [s for s in self._subscriptions.values()
+                           if s.pending]
+                due = [s for s in waiting if s.due <= now]
+                if not due:  # until one is, or more points are pending
+                    self._pushes.wait(min(s.due for s in waiting) - now
+                                      if waiting else None)
+                    continue
+                batches = []
+                for subscription in due:
+                    batches.append((subscription, subscription.pending))
+                    subscription.pending = {}
+                    subscription.due = now + subscription.interval
+            for subscription, points in batches:
+                try:
+                    subscription.protocol.send(points)
+                except socket.error:
+                    with self._pushes:
+                        self._subscriptions.pop(subscription.protocol, None)
+                        self._watchers = {}
 
 
 class BackendError(Exception):
@@ -112,189 +832,2490 @@ class BackendError(Exception):
     """Error in case a backend cannot execute a query."""
 
 
-class ServerBackend(object):
+def _combined(generations):
+    """Generation of a backend made of others, None if one cannot tell."""
+    generations = tuple(generations)
+    return None if None in generations else generations
 
-    """Backend that just delegates all queries to a remote server."""
 
-    def __init__(self, host='localhost', port=6283):
+_pool = None
+
+
+def _thread_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(2 * cpu_count())
+    return _pool
+
+
+class Backend(object):
+
+    """Base class with generic versions of the bulk operations."""
+
+    metrics = None
+
+    def _count(self, scanned, returned):
+        """Report the points a read scanned and returned, if instrumented."""
+        if self.metrics is not None:
+            self.metrics.points(type(self).__name__, scanned, returned)
+
+    _parallel = False  # whether get_many should fan out over threads
+
+    def set_many(self, points):
+        """Store an iterable of `(key, time, value)` points.
+
+        If it fails partway, the error tells in `written` how many of the
+        points were stored, so that only the rest are sent again.
+
+        """
+        written = 0
+        for key, time, value in points:
+            try:
+                self.set(key, time, value)
+            except BackendError as error:
+                error.written = written
+                raise
+            written += 1
+
+    def get_many(self, signals, start=None, end=None, limit=None):
+        """Get several signals at once, as a dict of signal to points.
+
+        Signals that the backend cannot get are left out.
+
+        """
+        def get(signal):
+            try:
+                return signal, self.get(signal, start, end, limit)
+            except BackendError:
+                return signal, None
+        signals = list(signals)
+        if self._parallel and len(signals) > 1:
+            got = _thread_pool().map(get, signals)
+        else:
+            got = map(get, signals)
+        return dict((s, points) for s, points in got if points is not None)
+
+    def iter_range(self, signal, start, end):
+        """Iterate over the points from `start` to `end`.
+
+        Backends that can read their storage piece by piece override this
+        to use constant memory however large the range is.
+
+        """
+        for point in self.get(signal, start, end):
+            yield point
+
+    def generation(self):
+        """Value that changes whenever `signals()` may change.
+
+        It is None if the backend cannot tell, as a remote one cannot.
+
+        """
+        return None
+
+    def sync(self, signals):
+        """Make the points of `signals` written so far survive an OS crash.
+
+        Backends that keep no files have nothing to do.
+
+        """
+
+    def get_arrays(self, signal, start=None, end=None, limit=None):
+        """Get points as a pair of int64 tick and float64 value arrays."""
+        return _arrays(self.get(signal, start, end, limit))
+
+    def aggregate(self, signal, start, end, bucket, function):
+        """Aggregate points from `start` to `end` into buckets.
+
+        Buckets are `bucket` seconds wide and aligned to multiples of their
+        width; `function` is one of `min`, `max`, `mean`, `sum`, `count`,
+        `first` or `last`. Returns `[bucket_start, aggregate]` pairs.
+
+        """
+        points = sorted(self.get(signal, start, end), key=itemgetter(0))
+        return _bucketed([_to_ticks(t) for t, _ in points],
+                         [v for _, v in points], bucket, function)
+
+
+class ServerBackend(Backend):
+
+    """Backend that just delegates all queries to a remote server.
+
+    Connections are kept open in a small pool and reused last-in,
+    first-out, so a single-threaded client always talks over the same
+    connection and sees its own writes in order.
+
+    The binary protocol is used unless `binary` is false or the server
+    turns out not to support it, in which case JSON is used. Such a
+    server is an old one, which hangs up after every command, so its
+    connections are not pooled.
+
+    """
+
+    _replies = ('get', 'get_many', 'aggregate', 'signals', 'stats')
+
+    def __init__(self, host='localhost', port=6283, connections=4,
+                 binary=True):
         self._host = host
         self._port = port
+        self._pool = LifoQueue(connections)
+        self._binary = binary
+        self._pooled = True
+
+    def _connect(self):
+        if self._binary:
+            try:
+                return BinaryProtocol(self._host, self._port).connect()
+            except EOFError:
+                self._binary = self._pooled = False
+        return TauProtocol(self._host, self._port).connect()
+
+    @contextmanager
+    def _protocol(self, fresh=False):
+        """Yield a pooled connection, or a `fresh` one, and if it is pooled.
+
+        The connection goes back to the pool unless an exception is raised.
+
+        """
+        protocol = None
+        while protocol is None and not fresh:
+            try:
+                protocol = self._pool.get_nowait()
+            except Empty:
+                break
+            if not protocol.idle():  # server hung up on a pooled one
+                protocol.close()
+                protocol = None
+        pooled = protocol is not None
+        if not pooled:
+            protocol = self._connect()
+        try:
+            yield protocol, pooled
+        except BaseException:  # including an abandoned iter_range
+            protocol.close()
+            raise
+        if not self._pooled:
+            protocol.close()
+            return
+        try:
+            self._pool.put_nowait(protocol)
+        except Full:
+            protocol.close()
+
+    def pipeline(self, commands, columns=False):
+        """Send `(command, arguments)` pairs at once, then read the replies.
+
+        Returns the replies of the commands that have one, in order; with
+        `columns`, series come as `(ticks, values)` arrays if the binary
+        protocol is used, and as lists of points otherwise. If a
+        pooled connection fails before any reply, the server may have hung
+        up on it without the commands being run, so they are sent once
+        more over a fresh connection; if that fails too, the error is
+        raised, even for commands without a reply, such as `set`.
+
+        """
+        commands = [[command, arguments] for command, arguments in commands]
+        for fresh in (False, True):
+            replies, pooled = [], False
+            try:
+                with self._protocol(fresh) as (protocol, pooled):
+                    protocol.columns = columns
+                    try:
+                        protocol.send_many(commands)
+                        for command, _ in commands:
+                            if command in self._replies:
+                                replies.append(protocol.receive())
+                    finally:
+                        protocol.columns = False
+                    return replies
+            except (socket.error, EOFError):
+                if replies or not pooled:
+                    raise
 
     def set(self, key, time, value):
-        with TauProtocol(self._host, self._port) as protocol:
-            protocol.send(['set', [key, time, value]])
+        self.pipeline([('set', [key, time, value])])
+
+    def set_many(self, points):
+        self.pipeline([('set_many', list(points))])
 
     def get(self, signal, start=None, end=None, limit=None):
-        with TauProtocol(self._host, self._port) as protocol:
-            protocol.send(['get', [signal, start, end, limit]])
-            return protocol.receive()
+        [result] = self.pipeline([('get', [signal, start, end, limit])])
+        return result
+
+    def get_arrays(self, signal, start=None, end=None, limit=None):
+        if numpy is None:
+            raise ImportError('as_arrays requires numpy')
+        [result] = self.pipeline([('get', [signal, start, end, limit])],
+                                 columns=True)
+        return result if isinstance(result, tuple) else _arrays(result)
+
+    def iter_range(self, signal, start, end):
+        with self._protocol() as (protocol, _):
+            protocol.send(['iter_range', [signal, start, end]])
+            while True:
+                chunk = protocol.receive()
+                if not chunk or isinstance(chunk, dict):
+                    break
+                for point in chunk:
+                    yield point
+        if chunk:
+            raise BackendError(chunk['error'])
+
+    def get_many(self, signals, start=None, end=None, limit=None):
+        [result] = self.pipeline([('get_many', [list(signals), start, end,
+                                                limit])])
+        return result
+
+    def aggregate(self, signal, start, end, bucket, function):
+        [result] = self.pipeline([('aggregate', [signal, start, end, bucket,
+                                                 function])])
+        return result
 
     def signals(self):
-        with TauProtocol(self._host, self._port) as protocol:
-            protocol.send(['signals', None])
-            return protocol.receive()
+        [result] = self.pipeline([('signals', None)])
+        return result
+
+    def subscribe(self, patterns, max_rate=10):
+        """Yield `{signal: [time, value]}` dicts as matching signals are set.
+
+        The first dict holds the latest points; after that the server
+        pushes the points set since, at most `max_rate` times a second.
+        A connection of its own is used until the iteration is closed.
+
+        """
+        protocol = self._connect()
+        try:
+            protocol.send(['subscribe', [list(patterns), max_rate]])
+            while True:
+                yield protocol.receive()
+        finally:
+            protocol.close()
+
+    def stats(self):
+        """Metrics of the server, or None if it does not collect them."""
+        [result] = self.pipeline([('stats', None)])
+        return result
 
     def clear(self):
-        with TauProtocol(self._host, self._port) as protocol:
-            protocol.send(['clear', None])
+        self.pipeline([('clear', None)])
+
+    def close(self):
+        """Close all pooled connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Empty:
+                break
+
+
+class _Series(object):
+
+    """Time-ordered points of one signal, evicted from the head.
+
+    Evicted points are only skipped over by moving `head`; the lists are
+    compacted once more than half of them is dead, so eviction costs
+    O(1) amortized.
+
+    """
+
+    def __init__(self):
+        self.times = []
+        self.values = []
+        self.head = 0
+
+    def __len__(self):
+        return len(self.times) - self.head
+
+    def append(self, time, value):
+        if self.times and time < self.times[-1]:  # keep it sorted
+            i = bisect_right(self.times, time, self.head)
+            self.times.insert(i, time)
+            self.values.insert(i, value)
+        else:
+            self.times.append(time)
+            self.values.append(value)
 
+    def evict(self, horizon):
+        """Drop points that are not newer than `horizon`."""
+        self.head = bisect_right(self.times, horizon, self.head)
+        if self.head > len(self.times) // 2:
+            del self.times[:self.head]
+            del self.values[:self.head]
+            self.head = 0
 
-class MemoryBackend(object):
+    def range(self, start, end):
+        lo = bisect_left(self.times, start, self.head)
+        hi = bisect_right(self.times, end, self.head)
+        return [[t, v] for t, v in zip(self.times[lo:hi],
+                                       self.values[lo:hi])]
+
+    def replace(self, start, end, points):
+        """Replace points from `start` up to (excluding) `end` by `points`."""
+        lo = bisect_left(self.times, start, self.head)
+        hi = bisect_left(self.times, end, self.head)
+        self.times[lo:hi] = [t for t, _ in points]
+        self.values[lo:hi] = [v for _, v in points]
+        return len(points) - (hi - lo)
+
+    def last(self):
+        return [self.times[-1], self.values[-1]]
+
+
+_TICK = timedelta(microseconds=1)
+
+
+def _overlap(intervals, start, end):
+    """Parts of half-open `intervals` that overlap with `[start, end)`."""
+    return [[max(s, start), min(e, end)] for s, e in intervals
+            if s < end and start < e]
+
+
+def _gaps(intervals, start, end):
+    """Parts of `[start, end)` not covered by sorted, disjoint `intervals`."""
+    gaps = []
+    for s, e in _overlap(intervals, start, end):
+        if start < s:
+            gaps.append([start, s])
+        start = e
+    if start < end:
+        gaps.append([start, end])
+    return gaps
+
+
+def _union(intervals, start, end):
+    """Add `[start, end)` to sorted, disjoint `intervals`."""
+    result = []
+    for s, e in intervals:
+        if e < start or end < s:
+            result.append([s, e])
+        else:
+            start, end = min(s, start), max(e, end)
+    result.append([start, end])
+    return sorted(result)
+
+
+class MemoryBackend(Backend):
 
     """In-memory backend that could be used as a cache for another backend."""
 
-    def __init__(self, cache_seconds=10):
+    def __init__(self, cache_seconds=10, max_points=None):
+        """Keep points for `cache_seconds`, or within `max_points`.
+
+        Expired points are evicted lazily, and only from the signal that is
+        being written or read; signals left without points are forgotten
+        on the next write or `signals`. With `cache_seconds=None` nothing
+        expires; instead the least recently used signals are evicted to
+        keep the backend within `max_points`.
+
+        """
         self._state = {}
         self._cache_seconds = cache_seconds
+        self._max_points = max_points
+        self._size = 0
+        self._used = OrderedDict()
+        self._filled = {}
+        self._since = datetime.min if cache_seconds else datetime.now()
+        self._started = datetime.now()
+        self._live = {}
+        self._generation = 0
+        self._lock = threading.Lock()
 
     def set(self, key, time, value):
-        if key not in self._state:
-            self._state[key] = []
-        self._state[key].append([time, value])
-        self._state = self._truncate(self._state, self._cache_seconds)
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        with self._lock:
+            touched = set()
+            for key, time, value in points:
+                if key not in self._state:
+                    self._state[key] = _Series()
+                    self._generation += 1
+                self._state[key].append(time, value)
+                self._size += 1
+                touched.add(key)
+            for key in touched:
+                self._touch(key)
+            self._sweep()
+            self._evict()
 
     def get(self, signal, start=None, end=None, limit=None):
-        self._state = self._truncate(self._state, self._cache_seconds)
-        if signal not in self._state or self._state[signal] == []:
-            return []
-        if start and end:
-            now = datetime.now()
-            period = now - timedelta(seconds=self._cache_seconds)
-            if not period < start < end < now:
-                raise BackendError('do not have data from `start` to `end`')
-            result = [kv for kv in self._state[signal] if start <= kv[0] <= end]
-            step = 1 if limit is None else len(result) / limit + 1
-            return result[::step]
-        return [self._state[signal][-1]]
+        with self._lock:
+            if self._cache_seconds and signal not in self._state:
+                return []
+            self._touch(signal)
+            series = self._state.get(signal) or []
+            if start and end:
+                if _gaps(self._coverage(signal), start, end + _TICK):
+                    raise BackendError('do not have data from `start` '
+                                       'to `end`')
+                result = series.range(start, end) if series else []
+                step = 1 if limit is None else len(result) // limit + 1
+                self._count(len(result), len(result[::step]))
+                return result[::step]
+            if not series:
+                return []
+            last = series.last()
+            if last[0] < self._live_since(signal):
+                return []  # newer points could have been evicted
+            return [last]
+
+    def missing(self, signal, start, end):
+        """Gaps of `[start, end)` for which this backend lacks points.
+
+        It has every point written since it started, within the last
+        `cache_seconds`; with `cache_seconds=None`, every point written
+        since it started (or since the signal was evicted), plus the
+        ranges a `GlueBackend` read through it and `fill`-ed in.
+
+        """
+        with self._lock:
+            return _gaps(self._held(signal), start, end)
+
+    def cached(self, signal, start, end):
+        """Points from `[start, end)` that lie in ranges held completely."""
+        with self._lock:
+            series = self._state.get(signal)
+            if not series:
+                return []
+            return [p for s, e in _overlap(self._held(signal), start, end)
+                    for p in series.range(s, e) if p[0] < e]
+
+    def fill(self, signal, start, end, points):
+        """Store all `points` of `[start, end)` read from a slower backend."""
+        if self._cache_seconds:
+            return  # only the live window is kept
+        with self._lock:
+            if signal not in self._state:
+                self._state[signal] = _Series()
+                self._generation += 1
+            self._size += self._state[signal].replace(start, end, points)
+            self._filled[signal] = _union(self._filled.get(signal, []),
+                                          start, end)
+            self._touch(signal)
+            self._evict()
 
     def signals(self):
-        return self._state.keys()
+        with self._lock:
+            self._sweep(everything=True)
+            return self._state.keys()
+
+    def generation(self):
+        return self._generation
+
+    def _horizon(self):
+        if not self._cache_seconds:
+            return datetime.min
+        return datetime.now() - timedelta(seconds=self._cache_seconds)
+
+    def _live_since(self, signal):
+        return max(self._since, self._live.get(signal, datetime.min))
+
+    def _coverage(self, signal):
+        horizon = self._horizon()
+        intervals = _union(self._filled.get(signal, []),
+                           self._live_since(signal), datetime.max)
+        return _overlap(intervals, horizon, datetime.max)
+
+    def _held(self, signal):
+        """Ranges of `signal` it has seen every point of, to read through."""
+        coverage = self._coverage(signal)
+        if self._cache_seconds:
+            coverage = _overlap(coverage, self._started, datetime.max)
+        return coverage
+
+    def _touch(self, signal):
+        """Expire old points of `signal` and mark it as recently used."""
+        series = self._state.get(signal)
+        if series is None:
+            return
+        size = len(series)
+        series.evict(self._horizon())
+        self._size -= size - len(series)
+        self._used.pop(signal, None)
+        self._used[signal] = True
+
+    def _sweep(self, everything=False):
+        """Forget signals all of whose points expired.
+
+        Signals are visited least recently used first, up to the first one
+        with points left unless `everything`, so that a write pays only
+        for the signals that expired since the previous one.
+
+        """
+        if not self._cache_seconds:
+            return
+        horizon = self._horizon()
+        expired = []
+        for signal in self._used:
+            series = self._state[signal]
+            size = len(series)
+            series.evict(horizon)
+            self._size -= size - len(series)
+            if not series:
+                expired.append(signal)
+            elif not everything:
+                break
+        for signal in expired:
+            del self._state[signal]
+            del self._used[signal]
+        if expired:
+            self._generation += 1
+
+    def _evict(self):
+        while self._max_points is not None and self._size > self._max_points:
+            signal, _ = self._used.popitem(last=False)
+            self._size -= len(self._state.pop(signal))
+            self._generation += 1
+            self._filled.pop(signal, None)
+            self._live[signal] = datetime.now()
+
+    def clear(self):
+        with self._lock:
+            self._state = {}
+            self._size = 0
+            self._used.clear()
+            self._filled = {}
+            self._live = {}
+            self._generation += 1
+            self._started = datetime.now()
+            if not self._cache_seconds:
+                self._since = self._started
 
-    @staticmethod
-    def _truncate(state, period):
-        now = datetime.now()
-        for key in state:
-            state[key] = [[t, v] for [t, v] in state[key]
-                          if (now - t).total_seconds() < period]
-        return state
+
+class _Catalog(object):
+
+    """Cached set of signals of a file backend, named `<signal><suffix>`.
+
+    The cache is kept up to date by the backend on `set` and `clear`, and
+    rescanned when the directory's mtime shows that somebody else added
+    or removed files (mtimes less than a second old are not trusted, as
+    some file systems only keep whole seconds). With `index`, the result
+    of each scan is also saved next to the data, so that a new process
+    can skip its first scan if nothing changed since.
+
+    """
+
+    def __init__(self, path, suffix, index=False):
+        self._path = path
+        self._suffix = suffix
+        self._index = (path + '.signals-' + suffix.lstrip('.')
+                       if index else None)
+        self._names = None
+        self._mtime = None
+        self._generation = 0  # bumped whenever the names change
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._names if self._fresh() else name in self.names()
+
+    def names(self):
+        """Set of all signals, rescanning the directory if it changed."""
+        with self._lock:
+            if not self._fresh():
+                self._load()
+            return self._names
+
+    def generation(self):
+        with self._lock:
+            if not self._fresh():
+                self._load()
+            return self._generation
+
+    def _fresh(self):
+        if self._names is None:
+            return False
+        mtime = os.stat(self._path).st_mtime
+        return mtime == self._mtime and time() - mtime > 1
+
+    def _load(self):
+        if self._index and not os.path.exists(self._index):
+            open(self._index, 'a').close()  # so that saving it keeps mtime
+        mtime = os.stat(self._path).st_mtime
+        if self._names is None and self._index:
+            try:
+                with open(self._index) as f:
+                    saved = json.load(f)
+                if saved['mtime'] == mtime and time() - mtime > 1:
+                    self._names, self._mtime = set(saved['names']), mtime
+                    return
+            except (IOError, ValueError, KeyError):
+                pass
+        n = len(self._suffix)
+        names = set(f[:-n] for f in os.listdir(self._path)
+                    if f.endswith(self._suffix))
+        if names != self._names:
+            self._names = names
+            self._generation += 1
+        self._mtime = mtime
+        if self._index:
+            with open(self._index, 'w') as f:
+                json.dump({'mtime': mtime, 'names': sorted(self._names)}, f)
+
+    def add(self, names):
+        with self._lock:
+            if self._names is not None and \
+                    not self._names.issuperset(names):
+                self._names.update(names)
+                self._generation += 1
 
     def clear(self):
-        self._state = {}
+        with self._lock:
+            self._names = set()
+            self._mtime = None
+            self._generation += 1
+
+
+def _fsync(filenames):
+    """Flush files that exist, and the directories they are in, to disk."""
+    directories = set()
+    for filename in filenames:
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(filename) or '.')
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _last_line(filename, block=4096):
+    """Return the last line of a file by reading it backwards in blocks."""
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = ''
+        while position > 0:
+            size = min(block, position)
+            position -= size
+            f.seek(position)
+            tail = f.read(size) + tail
+            lines = tail.rstrip('\n').rsplit('\n', 1)
+            if len(lines) == 2:
+                return lines[1]
+        return tail.rstrip('\n')
+
+
+_ENTRY = Struct('QQ')
+
+
+class _SparseIndex(object):
+
+    """Sparse index of the lines of a CSV file, kept in a `.idx` file.
 
+    Every `every`-th line appended gets an entry of its byte offset and of
+    the latest tick of the lines before it, so that a range query can seek
+    past all the lines that are too early, even if some were appended out
+    of order. Two header entries keep the latest tick of all lines, the
+    offset after the last line that went back in time (past which lines
+    are sorted, and a range query can stop at the first line after its
+    end), how much of the file is indexed, and how many lines.
 
-class CSVBackend(object):
+    """
 
-    """JSON-based file-oriented CSV backend."""
+    def __init__(self, filename, every=1000):
+        self._filename = filename
+        self._every = every
 
-    def __init__(self, path='./'):
+    def append(self, offset, lines):
+        """Index `(tick, length)` of the lines just appended at `offset`.
+
+        A missing or outdated index, as left by a crash or by an older
+        version, is rebuilt from the file first.
+
+        """
+        try:
+            f = open(self._filename + '.idx', 'r+b')
+        except IOError:
+            f = open(self._filename + '.idx', 'w+b')
+        with f:
+            header = f.read(2 * _ENTRY.size)
+            if len(header) == 2 * _ENTRY.size:
+                latest, ordered = _ENTRY.unpack_from(header)
+                size, count = _ENTRY.unpack_from(header, _ENTRY.size)
+            if len(header) < 2 * _ENTRY.size or size != offset:
+                lines = list(self._scan(offset)) + lines
+                latest = ordered = size = count = 0
+                f.truncate(2 * _ENTRY.size)
+            entries = []
+            for tick, length in lines:
+                if count % self._every == 0:
+                    entries.append(_ENTRY.pack(latest, size))
+                if tick < latest:
+                    ordered = size + length
+                latest = max(latest, tick)
+                size += length
+                count += 1
+            f.seek(0, os.SEEK_END)
+            f.write(''.join(entries))
+            f.seek(0)
+            f.write(_ENTRY.pack(latest, ordered) + _ENTRY.pack(size, count))
+
+    def _scan(self, end):
+        size = 0
+        with open(self._filename) as f:
+            for line in f:
+                if size + len(line) > end or not line.endswith('\n'):
+                    break
+                size += len(line)
+                yield _to_ticks(_parse_datetime(line.partition(',')[0])), \
+                        len(line)
+
+    def seek(self, start):
+        """Offset to read from for ticks from `start`, and of sorted lines.
+
+        The second offset is None if the index is out of date.
+
+        """
+        try:
+            index = _Column(open(self._filename + '.idx', 'rb'), 'QQ')
+        except IOError:
+            return 0, None
+        try:
+            if index.length < 2:
+                return 0, None
+            _, ordered = index.record(0)
+            size, _ = index.record(1)
+            if size != os.path.getsize(self._filename):
+                ordered = None  # appended to without updating the index
+            lo, hi = 2, index.length
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if index[mid] < start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return (index.record(lo - 1)[1] if lo > 2 else 0), ordered
+        finally:
+            index.close()
+
+
+class CSVBackend(Backend):
+
+    """JSON-based file-oriented CSV backend.
+
+    Each `<signal>.csv` gets a sparse `.csv.idx` index with an entry for
+    every `index_every` lines, which lets range queries skip the lines
+    before `start` and, once the file is in order, the lines after `end`.
+
+    """
+
+    _parallel = True
+
+    def __init__(self, path='./', index=False, index_every=1000):
         self._path = path
+        self._catalog = _Catalog(path, '.csv', index)
+        self._index_every = index_every
 
     def set(self, key, time, value):
-        with open(self._path + key + '.csv', 'a') as f:
-            f.write('%s,%s\n' % (time.isoformat(), json.dumps(value)))
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        lines = {}
+        for key, time, value in points:
+            lines.setdefault(key, []).append(
+                    (_to_ticks(time),
+                     '%s,%s\n' % (time.isoformat(), json.dumps(value))))
+        for key, chunk in lines.items():
+            filename = self._path + key + '.csv'
+            with open(filename, 'a') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(''.join(line for _, line in chunk))
+            _SparseIndex(filename, self._index_every).append(
+                    offset, [(tick, len(line)) for tick, line in chunk])
+        self._catalog.add(lines)
 
     def get(self, signal, start=None, end=None, limit=None):
-        if signal not in self.signals():
+        if signal not in self._catalog:
             return []
         if start and end:
-            result = []
-            with open(self._path + signal + '.csv') as f:
-                for line in f:
-                    t, _, v = line.partition(',')
-                    t = datetime.strptime(t, '%Y-%m-%dT%H:%M:%S.%f')
-                    if start <= t <= end:
-                        v = json.loads(v.strip())
-                        result.append([t, v])
+            result = list(self.iter_range(signal, start, end))
             step = 1 if limit is None else len(result) / limit + 1
             return result[::step]
-        ok = False
-        with open(self._path + signal + '.csv') as f:
+        line = _last_line(self._path + signal + '.csv')
+        if not line:
+            return []
+        t, _, v = line.partition(',')
+        t = _parse_datetime(t)
+        return [[t, json.loads(v.strip())]]
+
+    def iter_range(self, signal, start, end):
+        if signal not in self._catalog:
+            return
+        filename = self._path + signal + '.csv'
+        offset, ordered = _SparseIndex(filename).seek(_to_ticks(start))
+        scanned = returned = 0
+        with open(filename) as f:
+            f.seek(offset)
             for line in f:
+                scanned += 1
                 t, _, v = line.partition(',')
-                ok = True
-            if ok:
-                t = datetime.strptime(t, '%Y-%m-%dT%H:%M:%S.%f')
-                v = json.loads(v.strip())
-                return [[t, v]]
-        return []
+                t = _parse_datetime(t)
+                if start <= t <= end:
+                    returned += 1
+                    yield [t, json.loads(v.strip())]
+                elif t > end and ordered is not None and offset >= ordered:
+                    break
+                offset += len(line)
+        self._count(scanned, returned)
+
+    def sync(self, signals):
+        _fsync(self._path + s + '.csv' for s in signals)
 
     def signals(self):
-        return [f[:-4] for f in os.listdir(self._path) if f.endswith('.csv')]
+        return sorted(self._catalog.names())
+
+    def generation(self):
+        return self._catalog.generation()
 
     def clear(self):
         [os.remove(self._path + f) for f in os.listdir(self._path)
-         if f.endswith('.csv')]
+         if f.endswith('.csv') or f.endswith('.csv.idx')]
+        self._catalog.clear()
+
+
+def _to_ticks(date):
+    d = date - datetime.min
+    return (d.days * 86400 + d.seconds) * 10000000 + d.microseconds * 10
+
+
+def _to_date(ticks):
+    return datetime.min + timedelta(microseconds=ticks // 10)
+
+
+def _arrays(points):
+    """Convert `[date, value]` points to tick and value NumPy arrays."""
+    if numpy is None:
+        raise ImportError('as_arrays requires numpy')
+    try:
+        values = numpy.array([v for _, v in points], numpy.float64)
+    except (ValueError, TypeError):
+        raise BackendError('cannot convert values to float')
+    ticks = numpy.fromiter((_to_ticks(t) for t, _ in points), numpy.int64,
+                           len(points))
+    return ticks, values
+
+
+_AGGREGATES = {'min': min,
+               'max': max,
+               'sum': sum,
+               'count': len,
+               'mean': lambda values: sum(values) / float(len(values)),
+               'first': itemgetter(0),
+               'last': itemgetter(-1)}
+
+
+def _bucketed(ticks, values, bucket, function):
+    """Aggregate `values` into buckets of `bucket` seconds by their `ticks`.
+
+    `ticks` must be sorted. Each bucket is found by bisection and reduced
+    with a single builtin call over a slice of `values`.
+
+    """
+    if function not in _AGGREGATES:
+        raise BackendError('unknown aggregate function %r' % function)
+    width = int(bucket * 10000000)
+    if width <= 0:
+        raise BackendError('bucket must be positive, not %r' % bucket)
+    aggregate = _AGGREGATES[function]
+    result = []
+    i = 0
+    while i < len(ticks):
+        edge = ticks[i] - ticks[i] % width
+        j = bisect_left(ticks, edge + width, i)
+        try:
+            result.append([_to_date(edge), aggregate(values[i:j])])
+        except TypeError:
+            raise BackendError('cannot %s %r' % (function, values[i:j]))
+        i = j
+    return result
+
+
+class _Column(object):
+
+    """Read-only memory-mapped view of an open file of fixed-size records.
+
+    The file is closed along with the view.
+
+    """
+
+    def __init__(self, file, code, offset=0):
+        self._file = file
+        self._code = code
+        self._struct = Struct(code)
+        self._size = self._struct.size
+        self._offset = offset
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:  # cannot mmap an empty file
+            self._map = None
+        self.length = (max(len(self._map) - offset, 0) // self._size
+                       if self._map else 0)
+
+    def __getitem__(self, index):
+        return self.record(index)[0]
 
+    def record(self, index):
+        return self._struct.unpack_from(self._map,
+                                        self._offset + index * self._size)
 
-class BinaryBackend(object):
+    def slice(self, lo, hi):
+        """Decode records `lo` to `hi` in one bulk unpack."""
+        if hi <= lo:
+            return ()
+        return Struct('%d%s' % (hi - lo, self._code)).unpack_from(
+                self._map, self._offset + lo * self._size)
 
-    """Float32 binary, file-oriented backend."""
+    def array(self, lo, hi):
+        """View records `lo` to `hi` as a NumPy array without copying."""
+        if hi <= lo:
+            return numpy.empty(0, self._code)
+        return numpy.frombuffer(self._map, self._code, hi - lo,
+                                self._offset + lo * self._size)
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+
+_VALUE_MAGIC = '\x00TAU'
+_VALUE_HEADER = 8  # magic, type code and padding
+_PROMOTIONS = '?qd'  # bool, int64 and float64, each fitting in the next
+
+
+def _value_type(f):
+    """Type code of an open `.VALUE` file, None if it is empty.
+
+    Files without a header date from when every value was a float32.
+
+    """
+    f.seek(0)
+    header = f.read(_VALUE_HEADER)
+    if not header:
+        return None
+    if len(header) == _VALUE_HEADER and header.startswith(_VALUE_MAGIC):
+        return header[len(_VALUE_MAGIC)]
+    return 'f'
+
+
+def _value_header(code):
+    return _VALUE_MAGIC + code + '\x00' * (_VALUE_HEADER -
+                                           len(_VALUE_MAGIC) - 1)
+
+
+class _Dictionaries(object):
+
+    """Cached dictionaries of the strings of signals, kept in `.ENUM`.
+
+    The files are only appended to, so each lookup parses no more than
+    the lines added since the previous one.
+
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, prefix):
+        """List of the strings of a signal by code, and dict of their codes."""
+        with self._lock:
+            try:
+                f = open(prefix + '.ENUM')
+            except IOError:
+                return [], {}
+            with f:
+                stat = os.fstat(f.fileno())
+                cached = self._cache.get(prefix)
+                if cached is None or cached[0] != stat.st_ino or \
+                        cached[1] > stat.st_size:  # replaced meanwhile
+                    cached = self._cache[prefix] = [stat.st_ino, 0, [], {}]
+                _, size, names, codes = cached
+                if size < stat.st_size:
+                    f.seek(size)
+                    data = f.read()
+                    data = data[:data.rfind('\n') + 1]  # whole lines only
+                    for line in data.splitlines():
+                        name = json.loads(line)
+                        codes[name] = len(names)
+                        names.append(name)
+                    cached[1] = size + len(data)
+            return names, codes
+
+    def clear(self):
+        with self._lock:
+            self._cache = {}
+
+
+class _Columns(object):
+
+    """Tick and value columns of a binary signal, sorted by tick.
+
+    The type is read from the very file that is mapped, as `_promote` may
+    replace the `.VALUE` file with one of another type meanwhile.
+
+    """
+
+    def __init__(self, prefix, dictionaries):
+        values = open(prefix + '.VALUE', 'rb')
+        self.type = _value_type(values) or 'f'
+        self.values = _Column(values, self.type,
+                              0 if self.type == 'f' else _VALUE_HEADER)
+        self.ticks = _Column(open(prefix + '.TIME', 'rb'), 'Q')
+        self.length = min(self.ticks.length, self.values.length)
+        self._names = dictionaries(prefix)[0] if self.type == 'I' else None
+
+    def decode(self, values):
+        """Turn the codes of dictionary-encoded strings back into strings."""
+        if self._names is None:
+            return values
+        return [self._names[v] for v in values]
+
+    def __enter__(self):
+        return self
 
-    def __init__(self, path='./'):
+    def __exit__(self, exception_type, value, traceback):
+        self.ticks.close()
+        self.values.close()
+
+    def bisect_left(self, tick):
+        lo, hi = 0, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ticks[mid] < tick:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_right(self, tick):
+        lo, hi = 0, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tick < self.ticks[mid]:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+
+_ENCODERS = {'?': bool, 'q': int, 'd': float, 'f': float}
+
+
+def _value_kind(value, enums):
+    """Type code of the narrowest column that can hold `value`."""
+    if isinstance(value, bool):
+        return '?'
+    if isinstance(value, (int, long)):
+        return 'q' if -2 ** 63 <= value < 2 ** 63 else 'd'
+    if isinstance(value, float):
+        return 'd'
+    if isinstance(value, basestring):
+        try:
+            float(value)
+            return 'd'
+        except ValueError:
+            if enums:
+                return 'I'
+    raise BackendError('cannot convert %s to a number' % value)
+
+
+def _fits_float32(value):
+    """Check if a headerless float32 column can hold `value` exactly."""
+    if isinstance(value, basestring):
+        value = float(value)
+    try:
+        return _FLOAT32.unpack(_FLOAT32.pack(value))[0] == value
+    except OverflowError:
+        return False
+
+
+def _joined(kind, other):
+    """Type code of a column that can hold values of both kinds."""
+    if kind is None or kind == other:
+        return other
+    if kind in _PROMOTIONS and other in _PROMOTIONS:
+        return max(kind, other, key=_PROMOTIONS.index)
+    if kind == 'f' and other in _PROMOTIONS:
+        return 'f'
+    raise BackendError('cannot store %r values in a %r column' %
+                       (other, kind))
+
+
+class BinaryBackend(Backend):
+
+    """Typed binary, file-oriented backend.
+
+    Each signal is a `.TIME` column of ticks and a `.VALUE` column whose
+    header records its type: bool, int64 or float64, the narrowest that
+    fits the values written so far, widened in that order when needed
+    (which rewrites the column once). With `enums`, strings other than
+    numbers are stored as codes of a dictionary kept in `.ENUM`, of at
+    most `max_codes` strings per signal; otherwise they have to be
+    numbers. `.VALUE` files without a header are float32, as written by
+    older versions, and stay so until a value that float32 cannot hold
+    exactly is written, which makes them float64.
+
+    Ticks have to be appended in non-decreasing order, which lets range
+    queries binary-search the memory-mapped `.TIME` column; a batch with
+    an earlier point is rejected, for a `GlueBackend` to store elsewhere.
+
+    """
+
+    _parallel = True
+
+    max_codes = 1000  # more distinct strings are hardly states
+
+    def __init__(self, path='./', index=False, enums=False):
         self._path = path
+        self._catalog = _Catalog(path, '.VALUE', index)
+        self._enums = enums
+        self._dictionaries = _Dictionaries()
 
     def set(self, key, time, value):
-        def to_ticks(date):
-            d = date - datetime.min
-            return int(d.days * 864e9 + d.seconds * 1e7 + d.microseconds * 10)
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        """Append points with one write per column of each signal.
+
+        All values are converted before anything is written, so a batch
+        with a value that does not fit, or a point older than the last
+        one of its signal, is rejected as a whole.
+
+        """
+        columns = {}
+        for key, time, value in points:
+            ticks, values = columns.setdefault(key, ([], []))
+            ticks.append(_to_ticks(time))
+            values.append(value)
+        writes = []
+        for key, (ticks, values) in columns.items():
+            prefix = self._path + key
+            if ticks[0] < self._last_tick(prefix) or \
+                    any(a > b for a, b in zip(ticks, ticks[1:])):
+                raise BackendError('points of %r are out of order' % key)
+            try:
+                with open(prefix + '.VALUE', 'rb') as f:
+                    old = _value_type(f)
+            except IOError:
+                old = None
+            new = old
+            for value in values:
+                new = _joined(new, _value_kind(value, self._enums))
+                if new == 'f' and not _fits_float32(value):
+                    new = 'd'
+            names = []
+            if new == 'I':
+                codes = self._dictionaries(prefix)[1]
+                added = {}
+                for value in values:
+                    if value not in codes and value not in added:
+                        added[value] = len(codes) + len(added)
+                        names.append(value)
+                if len(codes) + len(added) > self.max_codes:
+                    raise BackendError('%r has more than %d distinct strings'
+                                       % (key, self.max_codes))
+                values = [codes[v] if v in codes else added[v]
+                          for v in values]
+            else:
+                values = map(_ENCODERS[new], values)
+            writes.append((prefix, old, new, ticks, values, names))
+        for prefix, old, new, ticks, values, names in writes:
+            if old and old != new:
+                self._promote(prefix, old, new)
+            if names:
+                with open(prefix + '.ENUM', 'a') as f:
+                    f.write(''.join(json.dumps(n) + '\n' for n in names))
+            with open(prefix + '.TIME', 'ab') as f:
+                f.write(Struct('%dQ' % len(ticks)).pack(*ticks))
+            with open(prefix + '.VALUE', 'ab') as f:
+                if not old:
+                    f.write(_value_header(new))
+                f.write(Struct('%d%s' % (len(values), new)).pack(*values))
+        self._catalog.add(columns)
+
+    @staticmethod
+    def _last_tick(prefix):
+        """Tick of the last point of a signal, 0 if it has none."""
         try:
-            value = float(value)
-        except (ValueError, TypeError):
-            raise BackendError('cannot convert %s to float' % value)
-        with open(self._path + key + '.TIME', 'ab') as times:
-            with open(self._path + key + '.VALUE', 'ab') as values:
-                t = Struct('Q').pack(to_ticks(time))
-                times.write(t)
-                v = Struct('f').pack(value)
-                values.write(v)
+            with open(prefix + '.TIME', 'rb') as f:
+                f.seek(-8, os.SEEK_END)
+                return Struct('Q').unpack(f.read(8))[0]
+        except IOError:
+            return 0
+
+    @staticmethod
+    def _promote(prefix, old, new):
+        """Rewrite the values of a signal as a wider type."""
+        column = _Column(open(prefix + '.VALUE', 'rb'), old,
+                         0 if old == 'f' else _VALUE_HEADER)
+        try:
+            values = map(_ENCODERS[new], column.slice(0, column.length))
+        finally:
+            column.close()
+        with open(prefix + '.VALUE.tmp', 'wb') as f:
+            f.write(_value_header(new))
+            f.write(Struct('%d%s' % (len(values), new)).pack(*values))
+        os.rename(prefix + '.VALUE.tmp', prefix + '.VALUE')
 
     def get(self, signal, start=None, end=None, limit=None):
-        def to_date(ticks):
-            return datetime.min + timedelta(microseconds=ticks / 10)
-        if signal not in self.signals():
+        if signal not in self._catalog:
+            return []
+        with _Columns(self._path + signal, self._dictionaries) as columns:
+            if start and end:
+                lo = columns.bisect_left(_to_ticks(start))
+                hi = columns.bisect_right(_to_ticks(end))
+                step = 1 if limit is None else (hi - lo) // limit + 1
+            else:
+                lo, hi, step = max(columns.length - 1, 0), columns.length, 1
+            ticks = columns.ticks.slice(lo, hi)[::step]
+            values = columns.decode(columns.values.slice(lo, hi)[::step])
+            if start and end:
+                self._count(hi - lo, len(ticks))
+            return [[_to_date(t), v] for t, v in zip(ticks, values)]
+
+    def iter_range(self, signal, start, end, chunk=65536):
+        if signal not in self._catalog:
+            return
+        with _Columns(self._path + signal, self._dictionaries) as columns:
+            lo = columns.bisect_left(_to_ticks(start))
+            hi = columns.bisect_right(_to_ticks(end))
+            for i in range(lo, hi, chunk):
+                j = min(i + chunk, hi)
+                for t, v in zip(columns.ticks.slice(i, j),
+                                columns.decode(columns.values.slice(i, j))):
+                    yield [_to_date(t), v]
+            self._count(hi - lo, hi - lo)
+
+    def get_arrays(self, signal, start=None, end=None, limit=None):
+        """Build the arrays straight from the column files.
+
+        The arrays are copied out of the memory map before it is closed,
+        but no Python object is created per point.
+
+        """
+        if numpy is None:
+            raise ImportError('as_arrays requires numpy')
+        if signal not in self._catalog:
+            return _arrays([])
+        with _Columns(self._path + signal, self._dictionaries) as columns:
+            if columns.type == 'I':
+                raise BackendError('cannot convert values to float')
+            if start and end:
+                lo = columns.bisect_left(_to_ticks(start))
+                hi = columns.bisect_right(_to_ticks(end))
+            else:
+                lo, hi = max(columns.length - 1, 0), columns.length
+            step = 1 if limit is None else (hi - lo) // limit + 1
+            ticks = columns.ticks.array(lo, hi)[::step]
+            values = columns.values.array(lo, hi)[::step]
+            return ticks.astype(numpy.int64), values.astype(numpy.float64)
+
+    def aggregate(self, signal, start, end, bucket, function):
+        if signal not in self._catalog:
+            return []
+        with _Columns(self._path + signal, self._dictionaries) as columns:
+            lo = columns.bisect_left(_to_ticks(start))
+            hi = columns.bisect_right(_to_ticks(end))
+            return _bucketed(columns.ticks.slice(lo, hi),
+                             columns.decode(columns.values.slice(lo, hi)),
+                             bucket, function)
+
+    def sync(self, signals):
+        _fsync(self._path + s + suffix for s in signals
+               for suffix in ('.TIME', '.VALUE', '.ENUM'))
+
+    def signals(self):
+        return sorted(self._catalog.names())
+
+    def generation(self):
+        return self._catalog.generation()
+
+    def clear(self):
+        [os.remove(self._path + f) for f in os.listdir(self._path)
+         if f.endswith('.TIME') or f.endswith('.VALUE') or
+         f.endswith('.ENUM')]
+        self._catalog.clear()
+        self._dictionaries.clear()
+
+
+class _BitWriter(object):
+
+    """Accumulate values of arbitrary bit width into bytes."""
+
+    def __init__(self):
+        self._bytes = bytearray()
+        self._word = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        self._word = (self._word << bits) | value
+        self._bits += bits
+        while self._bits >= 8:
+            self._bits -= 8
+            self._bytes.append((self._word >> self._bits) & 0xff)
+        self._word &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            return str(self._bytes) + chr(self._word << (8 - self._bits))
+        return str(self._bytes)
+
+
+class _BitReader(object):
+
+    """Read values of arbitrary bit width back from bytes."""
+
+    def __init__(self, data):
+        self._data = bytearray(data)
+        self._position = 0
+        self._word = 0
+        self._bits = 0
+
+    def read(self, bits):
+        while self._bits < bits:
+            self._word = (self._word << 8) | self._data[self._position]
+            self._position += 1
+            self._bits += 8
+        self._bits -= bits
+        value = self._word >> self._bits
+        self._word &= (1 << self._bits) - 1
+        return value
+
+
+# Prefix codes for delta-of-delta ticks: (prefix, prefix bits, value bits).
+_DELTAS = [(0b10, 2, 7), (0b110, 3, 12), (0b1110, 4, 20), (0b11110, 5, 32),
+           (0b11111, 5, 64)]
+
+
+def _compress(ticks, values):
+    """Encode ticks as delta-of-deltas and floats as XORs, Gorilla-style."""
+    bits = _BitWriter()
+    bits.write(ticks[0], 64)
+    delta = 0
+    for previous, tick in zip(ticks, ticks[1:]):
+        delta, dod = tick - previous, tick - previous - delta
+        if dod == 0:
+            bits.write(0, 1)
+            continue
+        for prefix, length, width in _DELTAS:
+            if -(1 << (width - 1)) <= dod < (1 << (width - 1)):
+                bits.write(prefix, length)
+                bits.write(dod & ((1 << width) - 1), width)
+                break
+    words = Struct('<%dQ' % len(values)).unpack(
+            Struct('<%dd' % len(values)).pack(*values))
+    bits.write(words[0], 64)
+    leading = trailing = None
+    for previous, word in zip(words, words[1:]):
+        xor = previous ^ word
+        if xor == 0:
+            bits.write(0, 1)
+            continue
+        lead = min(64 - xor.bit_length(), 31)
+        trail = (xor & -xor).bit_length() - 1
+        if leading is not None and lead >= leading and trail >= trailing:
+            bits.write(0b10, 2)
+            bits.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = lead, trail
+            bits.write(0b11, 2)
+            bits.write(leading, 5)
+            bits.write(64 - leading - trailing - 1, 6)
+            bits.write(xor >> trailing, 64 - leading - trailing)
+    return bits.getvalue()
+
+
+def _decompress(data, count):
+    bits = _BitReader(data)
+    ticks = [bits.read(64)]
+    delta = 0
+    for _ in range(count - 1):
+        dod = 0
+        if bits.read(1):
+            prefix, length = 1, 1
+            for p, l, width in _DELTAS:
+                while length < l:
+                    prefix = (prefix << 1) | bits.read(1)
+                    length += 1
+                if prefix == p:
+                    dod = bits.read(width)
+                    if dod >> (width - 1):
+                        dod -= 1 << width
+                    break
+        delta += dod
+        ticks.append(ticks[-1] + delta)
+    words = [bits.read(64)]
+    leading = trailing = 0
+    for _ in range(count - 1):
+        if not bits.read(1):
+            words.append(words[-1])
+            continue
+        if bits.read(1):
+            leading = bits.read(5)
+            trailing = 64 - leading - bits.read(6) - 1
+        xor = bits.read(64 - leading - trailing) << trailing
+        words.append(words[-1] ^ xor)
+    values = Struct('<%dd' % count).unpack(
+            Struct('<%dQ' % count).pack(*words))
+    return ticks, list(values)
+
+
+class CompressedBackend(Backend):
+
+    """Float64 binary backend storing points in compressed blocks.
+
+    New points are appended uncompressed to `<signal>.tail`. Once it holds
+    `block_size` points, they are compressed into one block of
+    `<signal>.blocks`: delta-of-delta encoded ticks and XOR encoded
+    floats, as in Facebook's Gorilla. Every block has a header with its
+    time range and size, so range queries skip blocks without decoding
+    them, and a trailer with its size, so the latest block can be found
+    from the end of the file. The tail starts with the size `.blocks` had
+    when it was started: blocks past that are not read, and are dropped
+    by the next seal, so a read or a crash in the middle of a seal never
+    sees its points twice.
+
+    """
+
+    _parallel = True
+
+    _header = Struct('<qqII')  # min tick, max tick, count, payload size
+    _trailer = Struct('<I')  # size of the whole block
+    _point = Struct('<qd')
+    _tail_header = Struct('<4s4xq')  # magic, size of `.blocks`
+
+    def __init__(self, path='./', block_size=1024, index=False):
+        self._path = path
+        self._block_size = block_size
+        self._catalog = _Catalog(path, '.tail', index)
+
+    def set(self, key, time, value):
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        tails = {}
+        for key, time, value in points:
+            try:
+                value = float(value)
+            except (ValueError, TypeError):
+                raise BackendError('cannot convert %s to float' % value)
+            tails.setdefault(key, []).append(
+                    self._point.pack(_to_ticks(time), value))
+        for key, tail in tails.items():
+            prefix = self._path + key
+            with open(prefix + '.tail', 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                if not f.tell():
+                    try:
+                        blocks = os.path.getsize(prefix + '.blocks')
+                    except OSError:
+                        blocks = 0
+                    f.write(self._tail_header.pack(_VALUE_MAGIC, blocks))
+                f.write(''.join(tail))
+                size = f.tell() - self._tail_header.size
+            if size >= self._block_size * self._point.size:
+                self._seal(key)
+        self._catalog.add(tails)
+
+    def _seal(self, key):
+        """Compress whole blocks of the tail and keep the rest there.
+
+        The new tail replaces the old one in a single rename, which is
+        what makes the blocks appended before it visible.
+
+        """
+        prefix = self._path + key
+        ticks, values, blocks = self._tail(key)
+        full = len(ticks) - len(ticks) % self._block_size
+        with open(prefix + '.blocks', 'ab') as f:
+            if blocks is not None:
+                f.truncate(blocks)  # left by a seal that did not finish
+            for i in range(0, full, self._block_size):
+                t = ticks[i:i + self._block_size]
+                payload = _compress(t, values[i:i + self._block_size])
+                f.write(self._header.pack(min(t), max(t), len(t),
+                                          len(payload)))
+                f.write(payload)
+                f.write(self._trailer.pack(self._header.size + len(payload) +
+                                           self._trailer.size))
+            f.seek(0, os.SEEK_END)
+            blocks = f.tell()
+        with open(prefix + '.tail.tmp', 'wb') as f:
+            f.write(self._tail_header.pack(_VALUE_MAGIC, blocks))
+            f.write(''.join(self._point.pack(t, v)
+                            for t, v in zip(ticks[full:], values[full:])))
+        os.rename(prefix + '.tail.tmp', prefix + '.tail')
+
+    def _tail(self, key):
+        """Points of the tail, and the size of `.blocks` that it follows.
+
+        The size is None for tails written by older versions, which follow
+        the whole file.
+
+        """
+        with open(self._path + key + '.tail', 'rb') as f:
+            data = f.read()
+        offset, blocks = 0, None
+        if data[:len(_VALUE_MAGIC)] == _VALUE_MAGIC:
+            blocks = self._tail_header.unpack_from(data)[1]
+            offset = self._tail_header.size
+        count = (len(data) - offset) // self._point.size
+        decoded = Struct('<' + 'qd' * count).unpack_from(data, offset)
+        return list(decoded[0::2]), list(decoded[1::2]), blocks
+
+    def _blocks(self, key, start, end, blocks=None):
+        """Decode the blocks that overlap with `start` to `end` ticks.
+
+        Only the first `blocks` bytes are read, if given.
+
+        """
+        try:
+            f = open(self._path + key + '.blocks', 'rb')
+        except IOError:
+            return
+        with f:
+            while blocks is None or f.tell() < blocks:
+                header = f.read(self._header.size)
+                if len(header) < self._header.size:
+                    break
+                low, high, count, size = self._header.unpack(header)
+                if high < start or low > end:
+                    f.seek(size + self._trailer.size, os.SEEK_CUR)
+                    continue
+                yield _decompress(f.read(size), count)
+                f.seek(self._trailer.size, os.SEEK_CUR)
+
+    def _last_block(self, key, blocks=None):
+        try:
+            f = open(self._path + key + '.blocks', 'rb')
+        except IOError:
+            return [], []
+        with f:
+            if blocks is None:
+                f.seek(0, os.SEEK_END)
+                blocks = f.tell()
+            if blocks < self._trailer.size:
+                return [], []
+            f.seek(blocks - self._trailer.size)
+            [size] = self._trailer.unpack(f.read(self._trailer.size))
+            f.seek(blocks - size)
+            low, high, count, size = self._header.unpack(
+                    f.read(self._header.size))
+            return _decompress(f.read(size), count)
+
+    def get(self, signal, start=None, end=None, limit=None):
+        if signal not in self._catalog:
             return []
         if start and end:
-            result = []
-            with open(self._path + signal + '.TIME') as time:
-                with open(self._path + signal + '.VALUE') as value:
-                    while True:
-                        Q = time.read(8)
-                        f = value.read(4)
-                        if len(Q) != 8 or len(f) != 4:
-                            break
-                        t = to_date(Struct('Q').unpack(Q)[0])
-                        if start <= t <= end:
-                            v = Struct('f').unpack(f)[0]
-                            result.append([t, v])
-            step = 1 if limit is None else len(result) / limit + 1
+            result = list(self.iter_range(signal, start, end))
+            step = 1 if limit is None else len(result) // limit + 1
             return result[::step]
-        ok = False
-        with open(self._path + signal + '.TIME') as time:
-            with open(self._path + signal + '.VALUE') as value:
-                while True:
-                    Q = time.read(8)
-                    f = value.read(4)
-                    if len(Q) != 8 or len(f) != 4:
-                        break
-                    t = to_date(Struct('Q').unpack(Q)[0])
-                    v = Struct('f').unpack(f)[0]
-                    ok = True
-                if ok:
-                    return [[t, v]]
-        return []
+        ticks, values, blocks = self._tail(signal)
+        if not ticks:
+            ticks, values = self._last_block(signal, blocks)
+        if not ticks:
+            return []
+        return [[_to_date(ticks[-1]), values[-1]]]
+
+    def iter_range(self, signal, start, end):
+        if signal not in self._catalog:
+            return
+        lo, hi = _to_ticks(start), _to_ticks(end)
+        ticks, values, blocks = self._tail(signal)
+        blocks = chain(self._blocks(signal, lo, hi, blocks), [(ticks, values)])
+        scanned = returned = 0
+        for ticks, values in blocks:
+            scanned += len(ticks)
+            for t, v in zip(ticks, values):
+                if lo <= t <= hi:
+                    returned += 1
+                    yield [_to_date(t), v]
+        self._count(scanned, returned)
+
+    def sync(self, signals):
+        _fsync(self._path + s + suffix for s in signals
+               for suffix in ('.tail', '.blocks'))
 
     def signals(self):
-        return [f.rstrip('.VALUE') for f in os.listdir(self._path)
-                if f.endswith('.VALUE')]
+        return sorted(self._catalog.names())
+
+    def generation(self):
+        return self._catalog.generation()
 
     def clear(self):
         [os.remove(self._path + f) for f in os.listdir(self._path)
-         if f.endswith('.TIME') or f.endswith('.VALUE')]
+         if f.endswith('.tail') or f.endswith('.blocks')]
+        self._catalog.clear()
+
+
+_SEGMENT = re.compile(r'^(\d+)-(\d+)$')
+
+
+class SegmentedBackend(Backend):
+
+    """Backend that partitions time into segments of a file backend.
+
+    Each segment is a directory of `path` named after the ticks it covers,
+    `<start>-<end>`, holding a `factory(directory)` backend, so range
+    queries only open the segments that overlap the range. New segments
+    are `segment_seconds` wide. Segments that ended more than `retention`
+    seconds ago are dropped as a whole by `expire`, and `compact` merges
+    the segments of every past `compact_seconds` window into one. Every
+    `interval` seconds both are run by a background thread. Reads take no
+    lock while they read segments, so the directories of dropped segments
+    are only deleted once no read is going on.
+
+    """
+
+    _parallel = True
+
+    def __init__(self, factory=BinaryBackend, path='./', segment_seconds=3600,
+                 retention=None, compact_seconds=None, interval=None):
+        width = int(segment_seconds * 10000000)
+        compact_width = int((compact_seconds or 0) * 10000000)
+        if width <= 0 or compact_width % width:
+            raise ValueError('compact_seconds must be a multiple of '
+                             'segment_seconds')
+        self._factory = factory
+        self._path = path
+        self._width = width
+        self._compact_width = compact_width
+        self._retention = retention
+        self._segments = {}
+        self._starts = []
+        self._ends = []
+        self._mtime = None
+        self._lock = threading.RLock()
+        self._collected = threading.Condition(self._lock)
+        self._readers = 0
+        self._doomed = set()  # directories of dropped segments
+        self._running = True
+        if interval:
+            maintainer = threading.Thread(target=self._maintain_periodically,
+                                          args=(interval,))
+            maintainer.daemon = True
+            maintainer.start()
+
+    def _directory(self, start, end):
+        return '%s%d-%d/' % (self._path, start, end)
+
+    def _scan(self):
+        """Pick up segments changed by others, like `_Catalog` does."""
+        mtime = os.stat(self._path).st_mtime
+        if mtime == self._mtime and time() - mtime > 1:
+            return
+        bounds = sorted((int(m.group(1)), int(m.group(2)))
+                        for m in map(_SEGMENT.match, os.listdir(self._path))
+                        if m and self._path + m.group() + '/'
+                        not in self._doomed)
+        self._segments = dict((b, self._segments.get(b) or
+                               self._factory(self._directory(*b)))
+                              for b in bounds)
+        self._starts = [start for start, _ in bounds]
+        self._ends = [end for _, end in bounds]
+        self._mtime = mtime
+
+    @contextmanager
+    def _reading(self):
+        """Keep dropped segments on disk until the block is left."""
+        with self._lock:
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._readers -= 1
+                self._collect()
+
+    def _collect(self):
+        """Delete the directories of dropped segments if nobody reads."""
+        if not self._readers:
+            for directory in self._doomed:
+                shutil.rmtree(directory)
+            self._doomed = set()
+            self._collected.notify_all()
+
+    def _overlapping(self, start, end):
+        """Backends of the segments that overlap `start` to `end`, in order."""
+        with self._lock:
+            self._scan()
+            i = bisect_right(self._ends, _to_ticks(start))
+            j = bisect_right(self._starts, _to_ticks(end))
+            return [self._segments[b]
+                    for b in zip(self._starts[i:j], self._ends[i:j])]
+
+    def _segment(self, tick):
+        """Find or create the segment that `tick` belongs to."""
+        i = bisect_right(self._starts, tick) - 1
+        if i >= 0 and tick < self._ends[i]:
+            return self._starts[i], self._ends[i]
+        start = tick - tick % self._width
+        bounds = start, start + self._width
+        while self._directory(*bounds) in self._doomed:
+            self._collected.wait()  # dropped, but still being read
+        os.mkdir(self._directory(*bounds))
+        self._segments[bounds] = self._factory(self._directory(*bounds))
+        i = bisect_left(self._starts, start)
+        self._starts.insert(i, bounds[0])
+        self._ends.insert(i, bounds[1])
+        return bounds
+
+    def set(self, key, time, value):
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        groups = {}
+        with self._lock:
+            self._scan()
+            created = len(self._segments)
+            for point in points:
+                bounds = self._segment(_to_ticks(point[1]))
+                groups.setdefault(bounds, []).append(point)
+            for bounds, group in sorted(groups.items()):
+                self._segments[bounds].set_many(group)
+            if len(self._segments) > created:
+                self.expire()
+
+    def get(self, signal, start=None, end=None, limit=None):
+        if start and end:
+            result = list(self.iter_range(signal, start, end))
+            step = 1 if limit is None else len(result) // limit + 1
+            return result[::step]
+        with self._reading():
+            with self._lock:
+                self._scan()
+                backends = [self._segments[b]
+                            for b in zip(self._starts, self._ends)]
+            for backend in reversed(backends):
+                got = backend.get(signal)
+                if got:
+                    return got
+        return []
+
+    def iter_range(self, signal, start, end):
+        with self._reading():
+            for backend in self._overlapping(start, end):
+                for point in backend.iter_range(signal, start, end):
+                    yield point
+
+    def aggregate(self, signal, start, end, bucket, function):
+        """Aggregate segment by segment if no bucket straddles two."""
+        width = int(bucket * 10000000)
+        if width <= 0 or self._width % width:
+            return Backend.aggregate(self, signal, start, end, bucket,
+                                     function)
+        result = []
+        with self._reading():
+            for backend in self._overlapping(start, end):
+                result.extend(backend.aggregate(signal, start, end, bucket,
+                                                function))
+        return result
+
+    def signals(self):
+        with self._reading():
+            with self._lock:
+                self._scan()
+                backends = self._segments.values()
+            return sorted(set(s for b in backends for s in b.signals()))
+
+    def generation(self):
+        with self._lock:
+            self._scan()
+            bounds = zip(self._starts, self._ends)
+            return _combined([tuple(bounds)] +
+                             [self._segments[b].generation() for b in bounds])
+
+    def sync(self, signals):
+        with self._lock:
+            for backend in self._segments.values():
+                backend.sync(signals)
+            _fsync([self._path])
+
+    def expire(self, now=None):
+        """Drop the segments that ended more than `retention` seconds ago."""
+        if self._retention is None:
+            return
+        cutoff = (now or datetime.now()) - timedelta(seconds=self._retention)
+        with self._lock:
+            self._scan()
+            for bounds in zip(self._starts, self._ends):
+                if bounds[1] <= _to_ticks(cutoff):
+                    self._drop(bounds)
+
+    def compact(self, now=None):
+        """Merge the segments of every `compact_seconds` window in the past.
+
+        Writes wait while segments are merged, so no point is lost.
+
+        """
+        if not self._compact_width:
+            return
+        current = _to_ticks(now or datetime.now())
+        with self._lock:
+            self._scan()
+            windows = {}
+            for bounds in zip(self._starts, self._ends):
+                window = bounds[0] - bounds[0] % self._compact_width
+                if window + self._compact_width <= current:
+                    windows.setdefault(window, []).append(bounds)
+            for window, parts in sorted(windows.items()):
+                if len(parts) > 1:
+                    self._merge(window, window + self._compact_width, parts)
+
+    def _merge(self, start, end, parts):
+        temporary = self._directory(start, end).rstrip('/') + '.tmp/'
+        if os.path.exists(temporary):  # left over from a crash
+            shutil.rmtree(temporary)
+        os.mkdir(temporary)
+        merged = self._factory(temporary)
+        for bounds in parts:
+            backend = self._segments[bounds]
+            first, last = _to_date(bounds[0]), _to_date(bounds[1] - 1)
+            for signal in backend.signals():
+                merged.set_many([(signal, t, v) for t, v in
+                                 backend.iter_range(signal, first, last)])
+        os.rename(temporary, self._directory(start, end))
+        for bounds in parts:
+            self._drop(bounds)
+        self._segments[start, end] = self._factory(self._directory(start,
+                                                                   end))
+        i = bisect_left(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+
+    def _drop(self, bounds):
+        self._doomed.add(self._directory(*bounds))
+        del self._segments[bounds]
+        i = self._starts.index(bounds[0])
+        del self._starts[i]
+        del self._ends[i]
+        self._collect()
+
+    def _maintain_periodically(self, interval):
+        while self._running:
+            sleep(interval)
+            try:
+                self.expire()
+                self.compact()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def clear(self):
+        with self._lock:
+            self._scan()
+            for bounds in zip(self._starts, self._ends):
+                self._drop(bounds)
+
+    def close(self):
+        """Stop expiring and compacting segments in the background."""
+        self._running = False
+
+
+def _logged(points):
+    """Lines of a write-ahead log of `points`."""
+    return ''.join(json.dumps([key, time.isoformat(), value]) + '\n'
+                   for key, time, value in points)
+
+
+class BufferedBackend(Backend):
+
+    """Backend that buffers writes to another backend and flushes in batches.
+
+    Every batch of points is appended to a write-ahead log before it is
+    acknowledged, and the log is replayed into `backend` on start-up, so
+    acknowledged points survive a crash. Buffered points are flushed with
+    one `set_many` call once there are `max_points` of them, or once the
+    oldest of them is `max_seconds` old. The log is fsync-ed after every
+    batch if `fsync` is 'always', before every flush if it is 'flush',
+    and never if it is 'never' (which survives a process crash, but not
+    an OS crash). Unless it is 'never', the backend is `sync`-ed before
+    the log is reset. Points the backend rejects, even one at a time, are
+    moved from the log to `<wal>.rejected` rather than tried forever.
+
+    """
+
+    def __init__(self, backend, wal='./tau.wal', max_points=1000,
+                 max_seconds=1, fsync='flush'):
+        if fsync not in ('always', 'flush', 'never'):
+            raise ValueError('unknown fsync policy %r' % fsync)
+        self._backend = backend
+        self._max_points = max_points
+        self._max_seconds = max_seconds
+        self._fsync = fsync
+        self._rejects = wal + '.rejected'
+        self._buffer = {}
+        self._backlog = 0
+        self._oldest = None
+        self._emptied = 0  # times the buffer was flushed or cleared
+        self._added = 0  # times a signal was added to the buffer
+        self._lock = threading.RLock()
+        self._stats = {'flushes': 0, 'flushed': 0, 'failures': 0,
+                       'rejected': 0, 'last_batch': 0, 'max_batch': 0,
+                       'last_flush_seconds': 0.0, 'max_flush_seconds': 0.0}
+        self._replay(wal)
+        self._wal = open(wal, 'a')
+        self._running = True
+        if max_seconds:
+            flusher = threading.Thread(target=self._flush_periodically)
+            flusher.daemon = True
+            flusher.start()
+
+    def _replay(self, wal):
+        if not os.path.exists(wal):
+            return
+        points = []
+        with open(wal) as f:
+            for line in f:
+                try:
+                    key, time, value = json.loads(line)
+                except ValueError:  # torn write of the last batch
+                    break
+                points.append((key, _parse_datetime(time), value))
+        if points:
+            self._store(points)
+            if self._fsync != 'never':
+                self._backend.sync(set(key for key, _, _ in points))
+        os.remove(wal)
+
+    def _store(self, points):
+        """Write `points` to the backend, one at a time past a failure.
+
+        The points it rejects even then are set aside in the reject file,
+        and counted as a failure.
+
+        """
+        try:
+            self._backend.set_many(points)
+            return
+        except BackendError as error:
+            written = getattr(error, 'written', 0)
+        rejected = []
+        for point in points[written:]:
+            try:
+                self._backend.set(*point)
+            except BackendError:
+                traceback.print_exc(file=sys.stderr)
+                rejected.append(point)
+        if rejected:
+            with open(self._rejects, 'a') as f:
+                f.write(_logged(rejected))
+                f.flush()
+                if self._fsync != 'never':
+                    os.fsync(f.fileno())
+            self._stats['failures'] += 1
+            self._stats['rejected'] += len(rejected)
+
+    def set(self, key, time, value):
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        points = list(points)
+        with self._lock:
+            self._wal.write(_logged(points))
+            self._wal.flush()
+            if self._fsync == 'always':
+                os.fsync(self._wal.fileno())
+            for key, time, value in points:
+                if key not in self._buffer:
+                    self._buffer[key] = []
+                    self._added += 1
+                self._buffer[key].append([time, value])
+            self._backlog += len(points)
+            if self._oldest is None:
+                self._oldest = datetime.now()
+            if self._backlog >= self._max_points:
+                self.flush()
+
+    def _flush_periodically(self):
+        while self._running:
+            sleep(self._max_seconds / 2.0)
+            with self._lock:
+                if self._oldest and ((datetime.now() - self._oldest)
+                                     .total_seconds() >= self._max_seconds):
+                    self.flush()
+
+    def flush(self):
+        """Write all buffered points to the backend and reset the log."""
+        with self._lock:
+            if not self._backlog:
+                return
+            started = datetime.now()
+            if self._fsync == 'flush':
+                os.fsync(self._wal.fileno())
+            points = [(key, t, v) for key, series in self._buffer.items()
+                      for t, v in series]
+            self._store(points)
+            if self._fsync != 'never':
+                self._backend.sync(self._buffer)
+            self._wal.truncate(0)
+            self._wal.seek(0)
+            seconds = (datetime.now() - started).total_seconds()
+            stats = self._stats
+            stats['flushes'] += 1
+            stats['flushed'] += len(points)
+            stats['last_batch'] = len(points)
+            stats['max_batch'] = max(stats['max_batch'], len(points))
+            stats['last_flush_seconds'] = seconds
+            stats['max_flush_seconds'] = max(stats['max_flush_seconds'],
+                                             seconds)
+            self._buffer = {}
+            self._backlog = 0
+            self._oldest = None
+            self._emptied += 1
+
+    def stats(self):
+        """Flush latencies, batch sizes and the number of points waiting."""
+        with self._lock:
+            stats = dict(self._stats, backlog=self._backlog)
+        stats['mean_batch'] = (float(stats['flushed']) / stats['flushes']
+                               if stats['flushes'] else 0.0)
+        return stats
+
+    def get(self, signal, start=None, end=None, limit=None):
+        while True:
+            with self._lock:
+                buffered = list(self._buffer.get(signal, []))
+                emptied = self._emptied
+            if not (start and end):
+                return [buffered[-1]] if buffered else \
+                    self._backend.get(signal)
+            result = self._backend.get(signal, start, end)
+            with self._lock:
+                if self._emptied == emptied:
+                    break  # else the backend may have some buffered points
+        result.extend(p for p in buffered if start <= p[0] <= end)
+        step = 1 if limit is None else len(result) // limit + 1
+        return result[::step]
+
+    def iter_range(self, signal, start, end):
+        if signal in self._buffer:  # it could be flushed while streaming
+            self.flush()
+        return self._backend.iter_range(signal, start, end)
+
+    def aggregate(self, signal, start, end, bucket, function):
+        if signal in self._buffer:
+            self.flush()
+        return self._backend.aggregate(signal, start, end, bucket, function)
+
+    def signals(self):
+        with self._lock:
+            return sorted(set(self._backend.signals()) | set(self._buffer))
+
+    def generation(self):
+        return _combined([self._backend.generation(), self._added])
+
+    def clear(self):
+        with self._lock:
+            self._buffer = {}
+            self._backlog = 0
+            self._oldest = None
+            self._emptied += 1
+            self._wal.truncate(0)
+            self._wal.seek(0)
+            self._backend.clear()
+
+    def close(self):
+        """Flush what is buffered and stop flushing in the background."""
+        self._running = False
+        self.flush()
+        self._wal.close()
+
+
+def _summary(value):
+    return {'count': 1, 'sum': value, 'min': value, 'max': value}
+
+
+def _merged(a, b):
+    return {'count': a['count'] + b['count'], 'sum': a['sum'] + b['sum'],
+            'min': min(a['min'], b['min']), 'max': max(a['max'], b['max'])}
+
+
+_SUMMARIZED = {'min': itemgetter('min'),
+               'max': itemgetter('max'),
+               'sum': itemgetter('sum'),
+               'count': itemgetter('count'),
+               'mean': lambda s: s['sum'] / float(s['count'])}
 
 
-class GlueBackend(object):
+class RollupBackend(Backend):
 
-    """Backend that glues together other backends."""
+    """Backend that keeps rollup tiers of another backend up to date."""
+
+    def __init__(self, backend, tiers=(60, 3600)):
+        """Roll up the points set in `backend` into `tiers`.
+
+        `tiers` maps bucket widths in seconds to the backends that store
+        the count, sum, min and max of each bucket; these take JSON values,
+        like `CSVBackend`. Given just the widths, each tier is kept in
+        memory for 1000 buckets.
+
+        """
+        if not isinstance(tiers, dict):
+            tiers = dict((w, MemoryBackend(cache_seconds=w * 1000))
+                         for w in tiers)
+        self._backend = backend
+        self._tiers = sorted((int(w * 10000000), b) for w, b in tiers.items())
+        self._open = {}
+        self._since = {}
+        self._lock = threading.Lock()
+
+    def set(self, key, time, value):
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        """Store points in `backend`, and update the buckets of numbers.
+
+        Buckets are written out once a later bucket starts or on `flush`;
+        late points are written as extra summaries of their bucket, merged
+        when read. A signal is rolled up from the bucket of its first point
+        set since this backend was made, or from the next bucket if
+        `backend` has earlier points in that one.
+
+        """
+        points = list(points)
+        self._backend.set_many(points)
+        closed = dict((width, []) for width, _ in self._tiers)
+        first = []
+        with self._lock:
+            for key, time, value in points:
+                if not isinstance(value, (int, long, float)):
+                    continue
+                tick = _to_ticks(time)
+                for width, _ in self._tiers:
+                    start = tick - tick % width
+                    current = self._open.get((key, width))
+                    if current and current[0] == start:
+                        current[1] = _merged(current[1], _summary(value))
+                    elif current and start < current[0]:
+                        closed[width].append((key, _to_date(start),
+                                              _summary(value)))
+                    else:
+                        if current:
+                            closed[width].append((key, _to_date(current[0]),
+                                                  current[1]))
+                        elif (key, width) not in self._since:
+                            first.append((key, width, start, tick))
+                        self._open[key, width] = [start, _summary(value)]
+            for width, tier in self._tiers:
+                if closed[width]:
+                    tier.set_many(closed[width])
+        for key, width, start, tick in first:
+            try:  # points set before this backend was made are not rolled up
+                whole = start == tick or not self._backend.get(
+                    key, _to_date(start), _to_date(tick) - _TICK)
+            except BackendError:
+                whole = False
+            with self._lock:
+                self._since.setdefault((key, width),
+                                       start if whole else start + width)
+
+    def flush(self):
+        """Write the buckets that are still filling up to their tiers."""
+        with self._lock:
+            for width, tier in self._tiers:
+                tier.set_many([(key, _to_date(start), summary)
+                               for (key, w), (start, summary)
+                               in self._open.items() if w == width])
+            self._open = {}
+
+    def _split(self, signal, start, end, width, align):
+        """Tick from which the tier of `width` has every point of `signal`.
+
+        It is rounded up to a multiple of `align`, and is None if the tier
+        has not got any point of the range.
+
+        """
+        with self._lock:
+            since = self._since.get((signal, width))
+        if since is None:
+            return None
+        since = max(since, _to_ticks(start))
+        since += -since % align
+        return since if since <= _to_ticks(end) else None
+
+    def _summaries(self, signal, start, end, width, tier):
+        """Sorted `(tick, summary)` buckets of a tier from `start` to `end`."""
+        lo = _to_ticks(start) - _to_ticks(start) % width
+        buckets = {}
+        for t, summary in tier.get(signal, _to_date(lo), end):
+            t = _to_ticks(t)
+            buckets[t] = _merged(buckets[t], summary) if t in buckets \
+                    else summary
+        with self._lock:
+            current = self._open.get((signal, width))
+            if current and lo <= current[0] <= _to_ticks(end):
+                t, summary = current
+                buckets[t] = _merged(buckets[t], summary) if t in buckets \
+                        else summary
+        return sorted(buckets.items())
+
+    def get(self, signal, start=None, end=None, limit=None):
+        """Get points, or with a `limit` the bucket means of a tier.
+
+        The tier is the coarsest at least as fine as the resolution asked
+        for. Whole buckets are read, so the first may include points from
+        just before `start`; the part of the range from before the tier
+        rolled up the signal is aggregated by `backend`.
+
+        """
+        if start and end and limit:
+            needed = (_to_ticks(end) - _to_ticks(start)) // limit
+            tiers = [(w, tier) for w, tier in self._tiers if w <= needed]
+            split = tiers and self._split(signal, start, end, tiers[-1][0],
+                                          tiers[-1][0])
+            if split:
+                width, tier = tiers[-1]
+                try:
+                    buckets = self._summaries(signal, _to_date(split), end,
+                                              width, tier)
+                    buckets = [[_to_date(t), _SUMMARIZED['mean'](summary)]
+                               for t, summary in buckets]
+                    if split > _to_ticks(start):
+                        buckets = self._backend.aggregate(
+                            signal, start, _to_date(split) - _TICK,
+                            width / 10000000.0, 'mean') + buckets
+                except BackendError:
+                    pass
+                else:
+                    step = 1 if len(buckets) <= limit else \
+                        len(buckets) // limit + 1
+                    return buckets[::step]
+        return self._backend.get(signal, start, end, limit)
+
+    def iter_range(self, signal, start, end):
+        return self._backend.iter_range(signal, start, end)
+
+    def aggregate(self, signal, start, end, bucket, function):
+        """Aggregate from the coarsest tier whose buckets divide `bucket`.
+
+        Queries that no tier can answer go to `backend`, and so does the
+        part of the range from before the tier rolled up the signal.
+
+        """
+        width = int(bucket * 10000000)
+        tiers = [(w, tier) for w, tier in self._tiers
+                 if width > 0 and width % w == 0]
+        split = (function in _SUMMARIZED and tiers and
+                 self._split(signal, start, end, tiers[-1][0], width))
+        if split:
+            try:
+                buckets = self._summaries(signal, _to_date(split), end,
+                                          *tiers[-1])
+                older = [] if split == _to_ticks(start) else \
+                    self._backend.aggregate(signal, start,
+                                            _to_date(split) - _TICK,
+                                            bucket, function)
+            except BackendError:
+                pass
+            else:
+                result = []
+                for t, summary in buckets:
+                    t -= t % width
+                    if result and result[-1][0] == t:
+                        result[-1][1] = _merged(result[-1][1], summary)
+                    else:
+                        result.append([t, summary])
+                return older + [[_to_date(t), _SUMMARIZED[function](summary)]
+                                for t, summary in result]
+        return self._backend.aggregate(signal, start, end, bucket, function)
+
+    def signals(self):
+        return self._backend.signals()
+
+    def generation(self):
+        return self._backend.generation()
+
+    def sync(self, signals):
+        self._backend.sync(signals)
+
+    def clear(self):
+        with self._lock:
+            self._open = {}
+            self._since = {}
+            for _, tier in self._tiers:
+                tier.clear()
+            self._backend.clear()
+
+
+class _Window(object):
+
+    """Cached result of a query from `start` to `end`, sorted by time."""
+
+    def __init__(self, start, end, points):
+        self.start = start
+        self.end = end
+        self.times = [t for t, _ in points]
+        self.values = [v for _, v in points]
+
+    def __len__(self):
+        return len(self.times)
+
+    def range(self, start, end):
+        lo = bisect_left(self.times, start)
+        hi = bisect_right(self.times, end)
+        return [[t, v] for t, v in zip(self.times[lo:hi],
+                                       self.values[lo:hi])]
+
+
+class CachedBackend(Backend):
+
+    """Backend that caches range queries to another backend.
+
+    The last result of each signal's `get` from `start` to `end`, and of
+    each of its `aggregate` functions and bucket widths, is kept, so that
+    a query of a window that slid forward, like a dashboard's, only reads
+    the points (or buckets) newer than the cached `end` from `backend`,
+    and cuts the ones older than `start` off the cached result.
+
+    A point set at or before the latest `end` queried of its signal drops
+    the signal's results, as does `clear`; points written to `backend`
+    other than through this one are not noticed. The least recently used
+    results are evicted to keep at most `max_points` points (or buckets).
+    Queries with a `limit` are not cached.
+
+    """
+
+    def __init__(self, backend, max_points=100000):
+        self._backend = backend
+        self._max_points = max_points
+        self._parallel = backend._parallel
+        self._windows = OrderedDict()
+        self._size = 0
+        self._horizons = {}
+        self._versions = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def set(self, key, time, value):
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        points = list(points)
+        self._backend.set_many(points)
+        earliest = {}
+        for key, time, _ in points:
+            earliest[key] = min(earliest.get(key, time), time)
+        with self._lock:
+            for key, time in earliest.items():
+                if key in self._horizons and time <= self._horizons[key]:
+                    self._versions[key] = self._versions.get(key, 0) + 1
+                    for query in [q for q in self._windows if q[0] == key]:
+                        self._size -= len(self._windows.pop(query))
+
+    def _lookup(self, query, end):
+        """Cached window of `query`, and the version to store a new one."""
+        signal = query[0]
+        with self._lock:
+            self._horizons[signal] = max(self._horizons.get(signal, end), end)
+            window = self._windows.pop(query, None)
+            if window is not None:
+                self._windows[query] = window  # most recently used
+            return window, (self._epoch, self._versions.get(signal, 0))
+
+    def _store(self, query, version, start, end, points):
+        with self._lock:
+            if version != (self._epoch, self._versions.get(query[0], 0)):
+                return  # something was set in the meantime
+            if query in self._windows:
+                if end < self._windows[query].end:
+                    return
+                self._size -= len(self._windows.pop(query))
+            if len(points) > self._max_points:
+                return
+            self._windows[query] = _Window(start, end, points)
+            self._size += len(points)
+            while self._size > self._max_points:
+                self._size -= len(self._windows.popitem(last=False)[1])
+
+    def get(self, signal, start=None, end=None, limit=None):
+        if not (start and end) or limit is not None:
+            return self._backend.get(signal, start, end, limit)
+        window, version = self._lookup((signal,), end)
+        fetch = lambda s, e: self._backend.get(signal, s, e)
+        if window is None or not (start <= window.end and
+                                  window.start <= end):
+            points = fetched = fetch(start, end)
+        else:
+            head = fetch(start, window.start - _TICK) \
+                    if start < window.start else []
+            tail = fetch(window.end + _TICK, end) if window.end < end else []
+            fetched = head + tail
+            points = (head + window.range(max(start, window.start),
+                                          min(end, window.end)) + tail)
+        self._count(len(fetched), len(points))
+        self._store((signal,), version, start, end, points)
+        return points
+
+    def aggregate(self, signal, start, end, bucket, function):
+        width = int(bucket * 10000000)
+        if width <= 0 or width % 10:  # edges must be whole microseconds
+            return self._backend.aggregate(signal, start, end, bucket,
+                                           function)
+        query = (signal, width, function)
+        window, version = self._lookup(query, end)
+        fetch = lambda s, e: self._backend.aggregate(signal, s, e, bucket,
+                                                     function)
+        first = _to_ticks(start)
+        first = _to_date(first + -first % width)
+        last = _to_ticks(min(end, window.end) if window else end) + 10
+        last = _to_date(last - last % width)
+        if window is None or not window.start <= start <= window.end or \
+                first > last:
+            points = fetched = fetch(start, end)
+        else:  # only the buckets wholly inside the window are reused
+            head = fetch(start, first - _TICK) if start < first else []
+            tail = fetch(last, end) if last <= end else []
+            fetched = head + tail
+            points = head + window.range(first, last - _TICK) + tail
+        self._count(len(fetched), len(points))
+        self._store(query, version, start, end, points)
+        return points
+
+    def iter_range(self, signal, start, end):
+        return self._backend.iter_range(signal, start, end)
+
+    def signals(self):
+        return self._backend.signals()
+
+    def generation(self):
+        return self._backend.generation()
+
+    def sync(self, signals):
+        self._backend.sync(signals)
+
+    def clear(self):
+        self._forget()
+        self._backend.clear()
+        self._forget()  # whatever was read while clearing
+
+    def _forget(self):
+        with self._lock:
+            self._windows.clear()
+            self._size = 0
+            self._horizons = {}
+            self._epoch += 1
+
+
+class GlueBackend(Backend):
+
+    """Backend that glues together other backends.
+
+    If the first backend keeps track of the time ranges it holds (as a
+    `MemoryBackend` does), it serves as a read-through cache for range
+    queries: it answers for the ranges it holds, only the gaps are read
+    from the other backends, and they are then filled into it.
+
+    """
 
     def __init__(self, *backends):
         self._backends = backends
@@ -310,7 +3331,45 @@ class GlueBackend(object):
         if not at_least_one:
             raise BackendError('no backend was able handle %r' % value)
 
+    def set_many(self, points):
+        """Store points in each backend that takes them.
+
+        Numbers and other values go in separate batches, since a backend
+        such as `BinaryBackend` rejects a whole batch with a value it
+        cannot store. A batch rejected anyway is retried point by point,
+        except for the points the backend reports to have `written`.
+
+        """
+        points = list(points)
+        numeric = [isinstance(v, (int, long, float)) for _, _, v in points]
+        batches = [[i for i, n in enumerate(numeric) if n],
+                   [i for i, n in enumerate(numeric) if not n]]
+        handled = [False] * len(points)
+        for b in self._backends:
+            for batch in filter(None, batches):
+                try:
+                    b.set_many([points[i] for i in batch])
+                    written = len(batch)
+                except BackendError as error:
+                    written = getattr(error, 'written', 0)
+                for i in batch[:written]:
+                    handled[i] = True
+                for i in batch[written:]:  # to find the culprits
+                    try:
+                        b.set(*points[i])
+                        handled[i] = True
+                    except BackendError:
+                        pass
+        for ok, (key, time, value) in zip(handled, points):
+            if not ok:
+                raise BackendError('no backend was able handle %r' % value)
+
     def get(self, signal, start=None, end=None, limit=None):
+        if start and end:
+            result = self._read_through(signal, start, end)
+            if result is not None:
+                step = 1 if limit is None else len(result) // limit + 1
+                return result[::step]
         for b in self._backends:
             got = None
             try:
@@ -324,23 +3383,326 @@ class GlueBackend(object):
             return got
         raise BackendError('cannot get %r' % signal)
 
+    def iter_range(self, signal, start, end):
+        if len(self._backends) > 1 and hasattr(self._backends[0], 'missing'):
+            return self._stream_through(signal, start, end)
+        return self._stream(signal, start, end)
+
+    def _stream_through(self, signal, start, end):
+        """Stream what the cache holds from it, and the gaps from the rest.
+
+        Unlike `_read_through`, gaps are not filled into the cache, as
+        ranges that are streamed are typically too large to be cached.
+
+        """
+        cache, rest = self._backends[0], GlueBackend(*self._backends[1:])
+        end += _TICK  # the cache deals in half-open ranges
+        gaps = cache.missing(signal, start, end)
+        pieces = sorted([(s, e, True) for s, e in _gaps(gaps, start, end)] +
+                        [(s, e, False) for s, e in gaps])
+        for piece_start, piece_end, held in pieces:
+            if held:
+                points = cache.cached(signal, piece_start, piece_end)
+            else:
+                points = rest.iter_range(signal, piece_start,
+                                         piece_end - _TICK)
+            for point in points:
+                yield point
+
+    def _stream(self, signal, start, end):
+        failed = 0
+        for b in self._backends:
+            points = b.iter_range(signal, start, end)
+            try:
+                first = next(points)
+            except StopIteration:
+                continue
+            except BackendError:
+                failed += 1
+                continue
+            yield first
+            for point in points:
+                yield point
+            return
+        if failed == len(self._backends):
+            raise BackendError('cannot get %r' % signal)
+
+    def _read_through(self, signal, start, end):
+        cache, rest = self._backends[0], self._backends[1:]
+        if not rest or not hasattr(cache, 'missing'):
+            return None
+        end += _TICK  # the cache deals in half-open ranges
+        result = cache.cached(signal, start, end)
+        gaps = cache.missing(signal, start, end)
+        rest = GlueBackend(*rest)
+        for gap_start, gap_end in gaps:
+            try:
+                points = rest.get(signal, gap_start, gap_end - _TICK)
+            except BackendError:
+                return None
+            cache.fill(signal, gap_start, gap_end, points)
+            result.extend(points)
+        if gaps:
+            result.sort(key=itemgetter(0))
+        return result
+
+    def get_many(self, signals, start=None, end=None, limit=None):
+        if start and end and hasattr(self._backends[0], 'missing'):
+            return Backend.get_many(self, signals, start, end, limit)
+        result = {}
+        empty = set()
+        remaining = list(signals)
+        for b in self._backends:
+            if not remaining:
+                break
+            try:
+                got = b.get_many(remaining, start, end, limit)
+            except BackendError:
+                continue
+            for signal, points in got.items():
+                if points:
+                    result[signal] = points
+                else:
+                    empty.add(signal)
+            remaining = [s for s in remaining if s not in result]
+        result.update((s, []) for s in remaining if s in empty)
+        return result
+
+    def aggregate(self, signal, start, end, bucket, function):
+        for b in self._backends:
+            got = None
+            try:
+                got = b.aggregate(signal, start, end, bucket, function)
+                if got == []:
+                    continue
+                return got
+            except BackendError:
+                pass
+        if got is not None:
+            return got
+        raise BackendError('cannot aggregate %r' % signal)
+
     def signals(self):
         signals = set()
         for backend in self._backends:
             signals.update(backend.signals())
         return sorted(signals)
 
+    def generation(self):
+        return _combined(b.generation() for b in self._backends)
+
+    def sync(self, signals):
+        for backend in self._backends:
+            backend.sync(signals)
+
     def clear(self):
         for b in self._backends:
             b.clear()
 
 
+class _SignalIndex(object):
+
+    """Sorted signal names that resolve glob patterns by literal prefix.
+
+    Only the names that share a pattern's literal prefix (everything up to
+    its first wildcard) are matched against it, and the matches of every
+    pattern are remembered, as the index is rebuilt whenever the set of
+    signals changes.
+
+    """
+
+    _compiled = {}
+
+    def __init__(self, signals):
+        self.signals = signals
+        self.generation = None  # of the backend the signals came from
+        self._sorted = sorted(signals)
+        self._matches = {}
+
+    def match(self, pattern):
+        if pattern not in self._matches:
+            prefix = re.match(r'[^*?[]*', pattern).group()
+            matches = self._compile(pattern)
+            result = []
+            for name in islice(self._sorted,
+                               bisect_left(self._sorted, prefix), None):
+                if not name.startswith(prefix):
+                    break
+                if matches(name):
+                    result.append(name)
+            self._matches[pattern] = result
+        return self._matches[pattern]
+
+    @classmethod
+    def _compile(cls, pattern):
+        matches = cls._compiled.get(pattern)
+        if matches is None:
+            if len(cls._compiled) > 1000:
+                cls._compiled.clear()
+            matches = cls._compiled[pattern] = re.compile(
+                    translate(pattern)).match
+        return matches
+
+
+def _hash(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return int(md5(name).hexdigest()[:16], 16)
+
+
+class ShardedBackend(Backend):
+
+    """Backend that spreads signals over several backends, the shards.
+
+    Signals are assigned to shards by consistent hashing: each shard owns
+    `replicas` points of a ring of md5 hashes, named after its position
+    among the shards, and a signal goes to the shard that owns the first
+    point after the hash of its name. Adding a shard with `add_shard`
+    only moves the signals that it takes over. Shards are typically
+    `ServerBackend`s of servers started with `tau server --port`, and
+    must be given in the same order every time.
+
+    """
+
+    _parallel = True
+
+    def __init__(self, *shards, **options):
+        self._replicas = options.get('replicas', 100)
+        self._shards = list(shards)
+        self._ring = self._build(len(shards))
+        self._locks = _KeyLocks()
+        self._pool = None
+
+    def _build(self, n):
+        """The ring of n shards as sorted `(hash, shard)` pairs."""
+        return sorted((_hash('%d:%d' % (shard, replica)), shard)
+                      for shard in range(n)
+                      for replica in range(self._replicas))
+
+    @staticmethod
+    def _owner(ring, signal):
+        i = bisect_right(ring, (_hash(signal),))
+        return ring[i % len(ring)][1]
+
+    def _shard(self, signal):
+        return self._shards[self._owner(self._ring, signal)]
+
+    def _fan_out(self, function, groups):
+        """Call `function(shard, items)` for each shard's group in parallel.
+
+        The router has a pool of its own: shards that fan out over the
+        shared pool would wait forever if the router had filled it up.
+
+        """
+        groups = groups.items()
+        if len(groups) > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(len(self._shards))
+            return self._pool.map(lambda g: function(*g), groups)
+        return [function(shard, items) for shard, items in groups]
+
+    def _grouped(self, items, key=lambda item: item):
+        groups = {}
+        for item in items:
+            groups.setdefault(self._owner(self._ring, key(item)),
+                              []).append(item)
+        return dict((self._shards[i], group) for i, group in groups.items())
+
+    def set(self, key, time, value):
+        self.set_many([(key, time, value)])
+
+    def set_many(self, points):
+        points = list(points)
+        with self._locks(key for key, _, _ in points):
+            self._fan_out(lambda shard, points: shard.set_many(points),
+                          self._grouped(points, key=itemgetter(0)))
+
+    def get(self, signal, start=None, end=None, limit=None):
+        return self._shard(signal).get(signal, start, end, limit)
+
+    def get_many(self, signals, start=None, end=None, limit=None):
+        result = {}
+        for got in self._fan_out(lambda shard, signals: shard.get_many(
+                signals, start, end, limit), self._grouped(signals)):
+            result.update(got)
+        return result
+
+    def iter_range(self, signal, start, end):
+        return self._shard(signal).iter_range(signal, start, end)
+
+    def aggregate(self, signal, start, end, bucket, function):
+        return self._shard(signal).aggregate(signal, start, end, bucket,
+                                             function)
+
+    def signals(self):
+        everywhere = dict((shard, None) for shard in self._shards)
+        return sorted(set(s for got in self._fan_out(
+            lambda shard, _: shard.signals(), everywhere) for s in got))
+
+    def generation(self):
+        return _combined(shard.generation() for shard in self._shards)
+
+    def sync(self, signals):
+        self._fan_out(lambda shard, signals: shard.sync(signals),
+                      self._grouped(signals))
+
+    def add_shard(self, shard, batch=10000):
+        """Add a shard and copy over the signals that it takes over.
+
+        Writes wait while the signals are copied; reads keep going to the
+        old shards until then. Old copies are left behind, since backends
+        cannot delete single signals; they are dropped by `clear`. So a
+        signal is only copied from its current owner, as the others may
+        hold stale copies from an earlier `add_shard`.
+
+        """
+        with self._locks.all():
+            ring = self._build(len(self._shards) + 1)
+            new = len(self._shards)
+            for i, old in enumerate(self._shards):
+                for signal in old.signals():
+                    if self._owner(ring, signal) != new or \
+                            self._owner(self._ring, signal) != i:
+                        continue
+                    if hasattr(old, 'cached'):  # refuses ranges it lacks
+                        points = iter(old.cached(signal, datetime.min,
+                                                 datetime.max))
+                    else:
+                        points = old.iter_range(signal, datetime.min,
+                                                datetime.max - _TICK)
+                    while True:
+                        chunk = [(signal, t, v) for t, v in
+                                 islice(points, batch)]
+                        if not chunk:
+                            break
+                        shard.set_many(chunk)
+            self._shards.append(shard)
+            self._ring = ring
+            pool, self._pool = self._pool, None  # one thread per shard
+            if pool is not None:
+                pool.close()
+
+    def clear(self):
+        with self._locks.all():
+            for shard in self._shards:
+                shard.clear()
+
+
 class Tau(object):
 
-    """High-level API that delegates the real work to a backend."""
+    """High-level API that delegates the real work to a backend.
 
-    def __init__(self, backend):
+    With `cache_points`, range queries go through a `CachedBackend` of
+    that size, so that repeating one over a sliding `period` only reads
+    what is new since the last time.
+
+    """
+
+    def __init__(self, backend, cache_points=None):
+        if cache_points:
+            backend = CachedBackend(backend, cache_points)
         self._backend = backend
+        self._index = None
 
     def __repr__(self):
         return 'Tau(%r)' % self._backend
@@ -348,8 +3710,12 @@ class Tau(object):
     def set(self, *arg, **kw):
         now = datetime.now()
         keyvalues = arg[0] if arg else kw
-        for key, value in keyvalues.items():
-            self._backend.set(key, now, value)
+        self._backend.set_many([(key, now, value)
+                                for key, value in keyvalues.items()])
+
+    def set_many(self, points):
+        """Store an iterable of `(key, time, value)` points in one batch."""
+        self._backend.set_many(points)
 
     def get(self, *arguments, **options):
         signals = self._matching_signals(*arguments)
@@ -361,14 +3727,32 @@ class Tau(object):
             else:
                 end = options['end']
                 start = options['start']
-            match = dict((s, self._backend.get(s, start, end,
-                                               options.get('limit')))
-                              for s in signals)
-            if not options.get('timestamps'):
+            if options.get('bucket') or options.get('aggregate'):
+                bucket = (options.get('bucket') or
+                          (end - start).total_seconds() /
+                          (options.get('limit') or 1))
+                function = options.get('aggregate') or 'mean'
+                match = dict((s, self._backend.aggregate(s, start, end,
+                                                         bucket, function))
+                             for s in signals)
+                if options.get('as_arrays'):
+                    match = dict((k, _arrays(v)) for k, v in match.items())
+            elif options.get('as_arrays'):
+                match = self._arrays(signals, start, end,
+                                     options.get('limit'))
+            else:
+                got = self._backend.get_many(signals, start, end,
+                                             options.get('limit'))
+                match = dict((s, got.get(s, [])) for s in signals)
+            if not options.get('timestamps') and \
+                    not options.get('as_arrays'):
                 match = dict((k, [i[1] for i in v]) for k, v in match.items())
+        elif options.get('as_arrays'):
+            match = self._arrays(signals)
         else:  # latest value
             d = lambda l: l[0] if l else None
-            match = dict((s, d(self._backend.get(s))) for s in signals)
+            got = self._backend.get_many(signals)
+            match = dict((s, d(got.get(s))) for s in signals)
             if not options.get('timestamps'):
                 match = dict((k, v[1] if v else None)
                              for k, v in match.items())
@@ -377,11 +3761,53 @@ class Tau(object):
             return match[arguments[0]]
         return match
 
+    def _arrays(self, signals, start=None, end=None, limit=None):
+        """Get `(ticks, values)` NumPy arrays of each of the `signals`."""
+        return dict((s, self._backend.get_arrays(s, start, end, limit))
+                    for s in signals)
+
+    def subscribe(self, *patterns, **options):
+        """Yield dicts of the values of matching signals as they are set.
+
+        Takes `max_rate` (updates a second) and `timestamps` options; needs
+        a backend that supports subscriptions, such as `ServerBackend`.
+
+        """
+        updates = self._backend.subscribe(patterns,
+                                          options.get('max_rate', 10))
+        for update in updates:
+            if not options.get('timestamps'):
+                update = dict((k, v[1]) for k, v in update.items())
+            yield update
+
+    def iter_range(self, signal, period=None, start=None, end=None,
+                   timestamps=False):
+        """Iterate over the values of `signal` without holding all of them."""
+        if period:
+            end = datetime.now()
+            start = end - timedelta(seconds=period)
+        for point in self._backend.iter_range(signal, start, end):
+            yield point if timestamps else point[1]
+
     def _matching_signals(self, *arg):
         patterns = [a for a in arg if self._is_pattern(a)]
         signals = [a for a in arg if not self._is_pattern(a)]
-        return set([s for p in patterns for s in self.signals()
-                    if fnmatchcase(s, p)] + signals)
+        if patterns:
+            index = self._signal_index()
+            signals.extend(s for p in patterns for s in index.match(p))
+        return set(signals)
+
+    def _signal_index(self):
+        """Rebuild the index if the backend's generation has changed."""
+        generation = self._backend.generation()
+        if self._index is not None and generation is not None and \
+                self._index.generation == generation:
+            return self._index
+        signals = self.signals()
+        if self._index is None or self._index.signals != signals:
+            self._index = _SignalIndex(signals)
+        self._index.generation = generation
+        return self._index
 
     @staticmethod
     def _is_pattern(s):
@@ -399,20 +3825,27 @@ class TauClient(Tau):
     """Shortcut for Tau(ServerBackend(...))."""
 
     def __init__(self, host='localhost', port=6283):
-        self._backend = ServerBackend(host, port)
+        Tau.__init__(self, ServerBackend(host, port))
 
 
 if __name__ == '__main__':
     args = docopt(__doc__, version='zero')
     backends = {'memory': MemoryBackend(),
-                'binary': BinaryBackend(),
+                'binary': BinaryBackend(enums=args['--enums']),
                 'csv':    CSVBackend(),
+                'compressed': CompressedBackend(),
+                'segmented': SegmentedBackend(
+                    lambda path: BinaryBackend(path, enums=args['--enums'])),
                 'server': ServerBackend()}
     backend = GlueBackend(*[backends[name] for name in args['-b']])
     tau = Tau(GlueBackend(backend))
     if args['server']:
         try:
-            TauServer(backend)
+            profile = args['--profile'] and int(args['--profile'])
+            cache = args['--cache'] and int(args['--cache'])
+            TauServer(backend, port=int(args['--port']),
+                      profile_every=profile,
+                      cache_points=cache).serve_forever()
         except KeyboardInterrupt:
             pass
     elif args['set']:
@@ -423,8 +3856,13 @@ if __name__ == '__main__':
                       period=f(args['--period']),
                       start=f(args['--start']),
                       end=f(args['--end']),
+                      bucket=f(args['--bucket']),
+                      aggregate=args['--aggregate'],
                       timestamps=args['--timestamps']))
     elif args['signals']:
         print(tau.signals())
     elif args['clear']:
         tau.clear()
+    elif args['stats']:
+        stats = ServerBackend(port=int(args['--port'])).stats()
+        print(json.dumps(stats, indent=4, sort_keys=True))
@@ -1,14 +1,24 @@
 import os
+import json
+import time
+import threading
+from struct import Struct
 from datetime import datetime, timedelta
 
-from pytest import raises, mark
+from pytest import raises, mark, importorskip
 
 from tau import MemoryBackend, BinaryBackend, CSVBackend, GlueBackend
-from tau import BackendError
+from tau import CompressedBackend, BufferedBackend, BackendError
+from tau import SegmentedBackend, RollupBackend, CachedBackend
+from tau import Metrics, Backend, _to_ticks
 
 
 glue_backend = lambda: GlueBackend(MemoryBackend(), CSVBackend())
-all = (MemoryBackend, BinaryBackend, CSVBackend, glue_backend)
+segmented_backend = lambda: SegmentedBackend(BinaryBackend,
+                                             segment_seconds=2)
+cached_backend = lambda: CachedBackend(BinaryBackend())
+all = (MemoryBackend, BinaryBackend, CSVBackend, CompressedBackend,
+       glue_backend, segmented_backend, cached_backend)
 
 
 def backends(*backends):
@@ -140,3 +150,724 @@ def test_glue_tries_to_get_from_other_backends_if_gets_empty_list():
 def test_file_backends_dont_fail_if_file_is_empty(backend):
     os.system('touch hai.csv hai.TIME hai.VALUE')
     assert backend.get('hai') == []
+
+
+@backends(BinaryBackend, CSVBackend, CompressedBackend)
+def test_backend_get_start_end_excludes_points_outside_range(backend):
+    for n in range(5):
+        backend.set('foo', t + seconds(n), n)
+    res = backend.get('foo', t + seconds(1), t + seconds(3))
+    assert [v for _, v in res] == [1, 2, 3]
+    assert [time for time, _ in res] == [t + seconds(n) for n in (1, 2, 3)]
+
+
+@backends(*all)
+def test_backend_iter_range(backend):
+    start = now()
+    for n in range(5):
+        backend.set('foo', start + seconds(n), n)
+    points = backend.iter_range('foo', start + seconds(1), start + seconds(3))
+    assert not isinstance(points, list)
+    assert list(points) == [[start + seconds(n), n] for n in (1, 2, 3)]
+    assert list(backend.iter_range('bar', start, start + seconds(5))) == []
+
+
+@backends(*all)
+def test_backend_get_arrays(backend):
+    numpy = importorskip('numpy')
+    start = now()
+    for n in range(5):
+        backend.set('foo', start + seconds(n), n + 0.5)
+    ticks, values = backend.get_arrays('foo', start + seconds(1),
+                                       start + seconds(3))
+    assert ticks.dtype == numpy.int64 and values.dtype == numpy.float64
+    assert list(values) == [1.5, 2.5, 3.5]
+    assert list(ticks) == [_to_ticks(start + seconds(n)) for n in (1, 2, 3)]
+    ticks, values = backend.get_arrays('foo')
+    assert list(values) == [4.5]
+    ticks, values = backend.get_arrays('bar', start, start + seconds(5))
+    assert len(ticks) == len(values) == 0
+
+
+@backends(*all)
+def test_backend_get_returns_latest_point(backend):
+    for n in range(1000):
+        backend.set('foo', t + timedelta(microseconds=n), n)
+    [[time, value]] = backend.get('foo')
+    assert value == 999
+    assert time == t + timedelta(microseconds=999)
+
+
+@backends(*all)
+def test_backend_set_many(backend):
+    backend.set_many([('foo', now(), 1), ('bar', now(), 2),
+                      ('foo', now(), 3)])
+    assert set(backend.signals()) == set(['foo', 'bar'])
+    assert [v for _, v in backend.get('foo', now() - seconds(1), now())] == \
+            [1, 3]
+    assert backend.get('bar')[0][1] == 2
+
+
+def test_binary_backend_set_many_rejects_whole_batch():
+    backend = BinaryBackend()
+    with raises(BackendError):
+        backend.set_many([('foo', t, 1), ('foo', t, 'I')])
+    assert backend.signals() == []
+
+
+def test_binary_backend_rejects_points_out_of_order():
+    backend = BinaryBackend()
+    for n in [1, 5]:
+        backend.set('foo', t + seconds(n), n)
+    for n in [2, 3, 4]:
+        with raises(BackendError):
+            backend.set('foo', t + seconds(n), n)
+    with raises(BackendError):
+        backend.set_many([('bar', t + seconds(2), 2), ('bar', t, 1)])
+    assert backend.signals() == ['foo']
+    assert backend.get('foo', t + seconds(2), t + seconds(4)) == []
+    glue = GlueBackend(backend, CSVBackend())
+    glue.set('foo', t + seconds(3), 3)
+    assert [v for _, v in CSVBackend().get('foo', t, t + seconds(4))] == [3]
+
+
+def test_glue_set_many_dispatches_point_by_point():
+    bin = BinaryBackend()
+    csv = CSVBackend()
+    glue = GlueBackend(bin, csv)
+    glue.set_many([('num', t, 1), ('str', t, 'value')])
+    assert bin.signals() == ['num']
+    assert set(csv.signals()) == set(['num', 'str'])
+    with raises(BackendError):
+        GlueBackend(BinaryBackend()).set_many([('num', t, 'I')])
+
+
+class PickyBackend(MemoryBackend):
+
+    """Memory backend that stores point by point, and rejects lists."""
+
+    set_many = Backend.set_many
+
+    def set(self, key, time, value):
+        if isinstance(value, list):
+            raise BackendError('cannot store %r' % value)
+        MemoryBackend.set_many(self, [(key, time, value)])
+
+
+def test_glue_set_many_does_not_repeat_points_written_before_a_failure():
+    picky = PickyBackend()
+    glue = GlueBackend(picky, CSVBackend())
+    glue.set_many([('foo', now(), 'a'), ('foo', now(), [1]),
+                   ('foo', now(), 'b'), ('foo', now(), 1)])
+    assert [v for _, v in picky.get('foo', now() - seconds(1), now())] == \
+            ['a', 'b', 1]
+    assert len(CSVBackend().get('foo', now() - seconds(1), now())) == 4
+
+
+def test_memory_backend_evicts_expired_points():
+    backend = MemoryBackend(1)
+    backend.set('old', now() - seconds(2), 1)
+    backend.set('foo', now() - seconds(2), 1)
+    backend.set('foo', now(), 2)
+    assert backend.get('old') == []
+    assert [v for _, v in backend.get('foo', now() - seconds(0.5), now())] \
+            == [2]
+    assert backend.signals() == ['foo']  # `old` was left without points
+
+
+def test_memory_backend_keeps_out_of_order_points_sorted():
+    backend = MemoryBackend()
+    backend.set('foo', now(), 2)
+    backend.set('foo', now() - seconds(0.5), 1)
+    backend.set('foo', now(), 3)
+    res = backend.get('foo', now() - seconds(1), now())
+    assert [v for _, v in res] == [1, 2, 3]
+    assert backend.get('foo')[0][1] == 3
+
+
+@backends(BinaryBackend, CSVBackend, CompressedBackend, glue_backend,
+          segmented_backend)
+def test_backend_aggregate(backend):
+    t0 = datetime(2020, 1, 1)
+    backend.set_many([('foo', t0 + seconds(n), n) for n in range(25)])
+    start, end = t0 + seconds(5), t0 + seconds(24)
+    assert backend.aggregate('foo', start, end, 10, 'min') == \
+            [[t0, 5], [t0 + seconds(10), 10], [t0 + seconds(20), 20]]
+    assert [v for _, v in backend.aggregate('foo', start, end, 10, 'max')] \
+            == [9, 19, 24]
+    assert [v for _, v in backend.aggregate('foo', start, end, 10, 'mean')] \
+            == [7, 14.5, 22]
+    assert [v for _, v in backend.aggregate('foo', start, end, 10, 'sum')] \
+            == [35, 145, 110]
+    assert [v for _, v in backend.aggregate('foo', start, end, 10,
+                                            'count')] == [5, 10, 5]
+    assert [v for _, v in backend.aggregate('foo', start, end, 10,
+                                            'first')] == [5, 10, 20]
+    assert [v for _, v in backend.aggregate('foo', start, end, 10,
+                                            'last')] == [9, 19, 24]
+    with raises(BackendError):
+        backend.aggregate('foo', start, end, 10, 'median')
+
+
+def test_compressed_backend_round_trips_across_blocks():
+    backend = CompressedBackend(block_size=16)
+    t0 = datetime(2020, 1, 1)
+    jitter = [0, 3, 250, 70000, 2 ** 40]
+    points = [(t0 + seconds(n) + timedelta(microseconds=jitter[n % 5]),
+               [0.0, 1.5, -2.25, 1e300, 7.0][n % 3 + n % 2])
+              for n in range(100)]
+    backend.set_many([('foo', time, value) for time, value in points])
+    assert backend.get('foo', t0, t0 + seconds(10 ** 7)) == \
+            [[time, value] for time, value in points]
+    assert backend.get('foo') == [list(points[-1])]
+    start, end = t0 + seconds(20), t0 + seconds(40)
+    assert backend.get('foo', start, end) == \
+            [[time, value] for time, value in points if start <= time <= end]
+    backend.set_many([('bar', t0 + seconds(n), 1.0) for n in range(32)])
+    assert backend.get('bar') == [[t0 + seconds(31), 1.0]]
+
+
+def test_compressed_backend_compresses_regular_series():
+    backend = CompressedBackend(block_size=1024)
+    t0 = datetime(2020, 1, 1)
+    backend.set_many([('foo', t0 + seconds(n), 20.0 + n % 4)
+                      for n in range(2048)])
+    assert os.path.getsize('foo.tail') == 16  # just its header
+    assert os.path.getsize('foo.blocks') < 2048 * 2
+
+
+def test_compressed_backend_reads_points_once_across_seals(tmpdir):
+    backend = CompressedBackend(str(tmpdir) + '/', block_size=4)
+    t0 = datetime(2020, 1, 1)
+    backend.set_many([('foo', t0 + seconds(n), n) for n in range(7)])
+    points = backend.iter_range('foo', t0, t0 + seconds(10))
+    first = next(points)
+    backend.set('foo', t0 + seconds(7), 7)  # seals the second block
+    assert [v for _, v in [first] + list(points)] == range(7)
+    tail = tmpdir.join('foo.tail').read('rb')
+    backend.set_many([('foo', t0 + seconds(n), n) for n in range(8, 12)])
+    tmpdir.join('foo.tail').write(tail, 'wb')  # as if it crashed sealing
+    assert [v for _, v in backend.get('foo', t0, t0 + seconds(20))] == \
+            range(8)
+    assert backend.get('foo')[0][1] == 7
+    backend.set_many([('foo', t0 + seconds(n), n) for n in range(8, 12)])
+    assert [v for _, v in backend.get('foo', t0, t0 + seconds(20))] == \
+            range(12)
+    tmpdir.join('old.tail').write(Struct('<qdqd').pack(
+            _to_ticks(t0), 1.0, _to_ticks(t0 + seconds(1)), 2.0), 'wb')
+    assert [v for _, v in backend.get('old', t0, t0 + seconds(1))] == [1, 2]
+
+
+def test_buffered_backend_flushes_in_batches(tmpdir):
+    csv = CSVBackend()
+    backend = BufferedBackend(csv, wal=str(tmpdir.join('wal')), max_points=3,
+                              max_seconds=None)
+    backend.set_many([('foo', now(), 1), ('bar', now(), 2)])
+    assert csv.signals() == []
+    assert backend.get('foo')[0][1] == 1
+    assert [v for _, v in backend.get('foo', now() - seconds(1), now())] \
+            == [1]
+    assert backend.stats()['backlog'] == 2
+    backend.set('foo', now(), 3)
+    assert [v for _, v in csv.get('foo', now() - seconds(1), now())] == [1, 3]
+    stats = backend.stats()
+    assert stats['backlog'] == 0
+    assert stats['flushes'] == 1
+    assert stats['last_batch'] == 3
+
+
+def test_buffered_backend_replays_its_log_after_a_crash(tmpdir):
+    csv = CSVBackend()
+    wal = str(tmpdir.join('wal'))
+    crashed = BufferedBackend(csv, wal=wal, max_points=100,
+                              max_seconds=None, fsync='always')
+    crashed.set_many([('foo', now(), 1), ('foo', now(), 2)])
+    assert csv.signals() == []
+    BufferedBackend(csv, wal=wal, max_seconds=None)
+    assert [v for _, v in csv.get('foo', now() - seconds(1), now())] == [1, 2]
+
+
+def test_buffered_backend_flushes_after_max_seconds(tmpdir):
+    csv = CSVBackend()
+    backend = BufferedBackend(csv, wal=str(tmpdir.join('wal')),
+                              max_seconds=0.1)
+    backend.set('foo', now(), 1)
+    time.sleep(0.3)
+    assert csv.get('foo')[0][1] == 1
+    backend.close()
+
+
+class UnreliableBackend(MemoryBackend):
+
+    """Memory backend that rejects writes while `failing`."""
+
+    failing = True
+    synced = ()
+
+    def set_many(self, points):
+        if self.failing:
+            raise BackendError('unavailable')
+        MemoryBackend.set_many(self, points)
+
+    def sync(self, signals):
+        self.synced = sorted(signals)
+
+
+def test_buffered_backend_sets_aside_points_the_backend_rejects(tmpdir):
+    inner = UnreliableBackend()
+    backend = BufferedBackend(inner, wal=str(tmpdir.join('wal')),
+                              max_seconds=None)
+    backend.set_many([('foo', now(), 1), ('bar', now(), 2)])
+    backend.flush()
+    assert backend.stats()['failures'] == 1
+    assert backend.stats()['rejected'] == 2
+    assert backend.stats()['backlog'] == 0
+    assert tmpdir.join('wal').read() == ''
+    assert len(tmpdir.join('wal.rejected').readlines()) == 2
+    inner.failing = False
+    backend.set('foo', now(), 3)
+    backend.flush()
+    assert inner.get('foo')[0][1] == 3
+    assert inner.synced == ['foo']
+
+
+def test_buffered_backend_stores_the_good_points_of_a_rejected_batch(tmpdir):
+    inner = BinaryBackend(str(tmpdir) + '/')
+    wal = str(tmpdir.join('wal'))
+    backend = BufferedBackend(inner, wal=wal, max_points=3,
+                              max_seconds=None)
+    backend.set_many([('x', now(), 1), ('x', now(), 'text'),
+                      ('x', now(), 2)])
+    backend.set('x', now(), 3)
+    backend.flush()
+    assert [v for _, v in inner.get('x', now() - seconds(1), now())] == \
+            [1, 2, 3]
+    assert backend.stats()['rejected'] == 1
+    backend.close()
+    with open(wal, 'w') as f:
+        f.write('["x", "%s", "text"]\n["x", "%s", 4]\n'
+                % (now().isoformat(), now().isoformat()))
+    backend = BufferedBackend(inner, wal=wal, max_seconds=None)
+    assert inner.get('x')[0][1] == 4
+    assert len(tmpdir.join('wal.rejected').readlines()) == 2
+    backend.close()
+
+
+class FlushingBackend(MemoryBackend):
+
+    """Memory backend that has `buffered` flushed as a read starts."""
+
+    buffered = None
+
+    def get(self, signal, start=None, end=None, limit=None):
+        if self.buffered and start and end:
+            self.buffered.flush()
+        return MemoryBackend.get(self, signal, start, end, limit)
+
+
+def test_buffered_backend_reads_points_flushed_meanwhile_once(tmpdir):
+    inner = FlushingBackend(cache_seconds=10 ** 9)
+    backend = BufferedBackend(inner, wal=str(tmpdir.join('wal')),
+                              max_seconds=None)
+    inner.buffered = backend
+    for read in [lambda: backend.get('foo', t, t + seconds(1)),
+                 lambda: list(backend.iter_range('foo', t, t + seconds(1)))]:
+        backend.set_many([('foo', t, 1), ('foo', t + seconds(1), 2)])
+        assert [v for _, v in read()] == [1, 2]
+        backend.clear()
+    backend.close()
+
+
+@backends(BinaryBackend, CSVBackend, CompressedBackend)
+def test_file_backends_notice_signals_added_by_others(backend):
+    backend.set('foo', t, 1)
+    assert backend.signals() == ['foo']
+    generation = backend.generation()
+    os.system('touch bar.csv bar.TIME bar.VALUE bar.tail')
+    assert backend.signals() == ['bar', 'foo']
+    assert backend.generation() != generation
+    assert backend.get('bar') == []
+
+
+def test_binary_backend_signal_names_keep_their_endings():
+    backend = BinaryBackend()
+    backend.set('valve', t, 1)
+    assert backend.signals() == ['valve']
+
+
+def test_file_backend_catalog_index(tmpdir):
+    path = str(tmpdir) + '/'
+    CSVBackend(path, index=True).set('foo', t, 1)
+    assert CSVBackend(path, index=True).signals() == ['foo']
+    saved = json.loads(tmpdir.join('.signals-csv').read())
+    assert saved['mtime'] == tmpdir.stat().mtime
+    assert CSVBackend(path).signals() == ['foo']
+
+
+@backends(*all)
+def test_backend_get_many(backend):
+    backend.set_many([('foo', now(), 1), ('bar', now(), 2), ('foo', now(), 3)])
+    got = backend.get_many(['foo', 'bar', 'baz'])
+    assert [v for _, v in got['foo']] == [3]
+    assert [v for _, v in got['bar']] == [2]
+    assert got.get('baz', []) == []
+    got = backend.get_many(['foo', 'bar'], now() - seconds(1), now())
+    assert [v for _, v in got['foo']] == [1, 3]
+    assert [v for _, v in got['bar']] == [2]
+
+
+def test_glue_get_many_falls_back_per_signal():
+    mem = MemoryBackend(1)
+    csv = CSVBackend()
+    glue = GlueBackend(mem, csv)
+    csv.set('old', now() - seconds(5), 1)
+    glue.set('new', now(), 2)
+    got = glue.get_many(['old', 'new'], now() - seconds(10), now())
+    assert [v for _, v in got['old']] == [1]
+    assert [v for _, v in got['new']] == [2]
+
+
+def recording(backend):
+    """Make `backend` remember the `(signal, start, end)` of its reads."""
+    backend.reads = []
+
+    def recorded(read):
+        def record(signal, start=None, end=None, *arguments):
+            backend.reads.append((signal, start, end))
+            return read(signal, start, end, *arguments)
+        return record
+
+    backend.get = recorded(backend.get)
+    backend.aggregate = recorded(backend.aggregate)
+    return backend
+
+
+def test_glue_reads_through_memory_cache():
+    csv = recording(CSVBackend())
+    t0 = datetime(2020, 1, 1)
+    csv.set_many([('foo', t0 + seconds(n), n) for n in range(10)])
+    mem = MemoryBackend(cache_seconds=None)
+    glue = GlueBackend(mem, csv)
+    assert [v for _, v in glue.get('foo', t0 + seconds(2), t0 + seconds(5))] \
+            == [2, 3, 4, 5]
+    assert mem.missing('foo', t0 + seconds(2), t0 + seconds(5)) == []
+    csv.reads = []
+    assert [v for _, v in glue.get('foo', t0 + seconds(3), t0 + seconds(4))] \
+            == [3, 4]
+    assert csv.reads == []
+    assert [v for _, v in glue.get('foo', t0, t0 + seconds(9))] == range(10)
+    assert [[round((t - t0).total_seconds()) for t in r[1:]]
+            for r in csv.reads] == [[0, 2], [5, 9]]
+    glue.set('foo', now(), 10)
+    csv.reads = []
+    assert [v for _, v in glue.get('foo', t0 + seconds(8), now())] == \
+            [8, 9, 10]
+    assert len(csv.reads) == 1  # only the gap between t0 + 9 and now
+
+
+def test_glue_streams_ranges_through_memory_cache_without_filling_it():
+    csv = CSVBackend()
+    t0 = datetime(2020, 1, 1)
+    csv.set_many([('foo', t0 + seconds(n), n) for n in range(10)])
+    mem = MemoryBackend(cache_seconds=None)
+    glue = GlueBackend(mem, csv)
+    glue.set('foo', now(), 10)
+    points = glue.iter_range('foo', t0 + seconds(5), now())
+    assert [v for _, v in points] == [5, 6, 7, 8, 9, 10]
+    assert mem.missing('foo', t0, t0 + seconds(9)) == \
+            [[t0, t0 + seconds(9)]]
+
+
+def test_glue_reads_recent_points_written_before_memory_started():
+    CSVBackend().set_many([('foo', now() - seconds(2), 1),
+                           ('foo', now() - seconds(1), 2)])
+    glue = GlueBackend(MemoryBackend(), CSVBackend())
+    assert [v for _, v in glue.get('foo', now() - seconds(5), now())] == \
+            [1, 2]
+    glue.set('foo', now(), 3)
+    assert [v for _, v in glue.get('foo', now() - seconds(5), now())] == \
+            [1, 2, 3]
+
+
+def test_memory_cache_evicts_least_recently_used_signals():
+    csv = CSVBackend()
+    t0 = datetime(2020, 1, 1)
+    csv.set_many([(key, t0 + seconds(n), n) for key in 'abc'
+                  for n in range(4)])
+    mem = MemoryBackend(cache_seconds=None, max_points=8)
+    glue = GlueBackend(mem, csv)
+    for key in 'abc':
+        assert len(glue.get(key, t0, t0 + seconds(3))) == 4
+    assert mem.missing('a', t0, t0 + seconds(3)) != []
+    assert mem.missing('b', t0, t0 + seconds(3)) == []
+    assert mem.missing('c', t0, t0 + seconds(3)) == []
+    with raises(BackendError):
+        mem.get('a', t0, t0 + seconds(3))
+
+
+def test_segmented_backend_opens_only_overlapping_segments(tmpdir):
+    path = str(tmpdir) + '/'
+    backend = SegmentedBackend(CSVBackend, path, segment_seconds=60)
+    t0 = datetime(2020, 1, 1)
+    backend.set_many([('foo', t0 + seconds(n), n) for n in range(0, 300, 30)])
+    assert len(os.listdir(path)) == 5
+    assert len(backend._overlapping(t0 + seconds(70), t0 + seconds(130))) \
+            == 2
+    got = backend.get('foo', t0 + seconds(50), t0 + seconds(150))
+    assert [v for _, v in got] == [60, 90, 120, 150]
+    assert backend.get('foo')[0][1] == 270
+    assert SegmentedBackend(CSVBackend, path).signals() == ['foo']
+
+
+def test_segmented_backend_drops_expired_segments(tmpdir):
+    path = str(tmpdir) + '/'
+    backend = SegmentedBackend(BinaryBackend, path, segment_seconds=60,
+                               retention=120)
+    t0 = now().replace(second=0, microsecond=0) - seconds(300)
+    backend.set_many([('foo', t0 + seconds(n), n) for n in range(0, 300, 30)])
+    assert len(os.listdir(path)) == 2  # expired as new segments were made
+    got = backend.get('foo', t0, t0 + seconds(300))
+    assert [v for _, v in got] == [180, 210, 240, 270]
+    backend.expire(now=t0 + seconds(600))
+    assert os.listdir(path) == []
+    backend.set('foo', now(), 1)
+    assert len(os.listdir(path)) == 1
+
+
+def test_segmented_backend_compacts_past_windows(tmpdir):
+    path = str(tmpdir) + '/'
+    backend = SegmentedBackend(BinaryBackend, path, segment_seconds=60,
+                               compact_seconds=3600)
+    t0 = datetime(2020, 1, 1)
+    points = [(key, t0 + seconds(n), n) for key in 'ab'
+              for n in range(0, 7200, 600)]
+    backend.set_many(points)
+    assert len(os.listdir(path)) == 12
+    backend.compact(now=t0 + seconds(5400))
+    assert len(os.listdir(path)) == 7
+    backend.compact(now=t0 + seconds(7200))
+    assert len(os.listdir(path)) == 2
+    got = backend.get('b', t0, t0 + seconds(7200))
+    assert [v for _, v in got] == range(0, 7200, 600)
+    backend.set('a', t0 + seconds(3500), -1)
+    assert len(os.listdir(path)) == 2
+    got = backend.get('a', t0 + seconds(3000), t0 + seconds(3599))
+    assert [v for _, v in got] == [3000, -1]
+
+
+def test_segmented_backend_compacts_while_being_read(tmpdir):
+    path = str(tmpdir) + '/'
+    backend = SegmentedBackend(CSVBackend, path, segment_seconds=60,
+                               compact_seconds=3600)
+    t0 = datetime(2020, 1, 1)
+    backend.set_many([('foo', t0 + seconds(n), n)
+                      for n in range(0, 3600, 600)])
+    points = backend.iter_range('foo', t0, t0 + seconds(3600))
+    assert next(points)[1] == 0  # has picked the segments to read
+    compacting = threading.Thread(target=backend.compact,
+                                  kwargs={'now': t0 + seconds(3600)})
+    compacting.start()
+    compacting.join()
+    assert backend.get('foo', t0, t0 + seconds(3600))[-1][1] == 3000
+    assert len(os.listdir(path)) == 7  # the old ones are still being read
+    assert [v for _, v in points] == range(600, 3600, 600)
+    assert len(os.listdir(path)) == 1
+
+
+def test_rollup_backend_aggregates_from_tiers(tmpdir):
+    raw = recording(CSVBackend())
+    tiers = {}
+    for width in (60, 3600):
+        tmpdir.mkdir(str(width))
+        tiers[width] = CSVBackend('%s/%d/' % (tmpdir, width))
+    rollup = RollupBackend(raw, tiers)
+    t0 = datetime(2020, 1, 1)
+    for n in range(0, 720, 20):
+        rollup.set_many([('foo', t0 + seconds(10 * i), i)
+                         for i in range(n, n + 20)])
+    rollup.set('foo', t0 + seconds(5), 1000)  # late
+    end = t0 + seconds(7199)
+    for function in ['min', 'max', 'mean', 'count', 'sum']:
+        for bucket in [600, 3600, 7200]:
+            expected = raw.aggregate('foo', t0, end, bucket, function)
+            raw.reads = []
+            assert rollup.aggregate('foo', t0, end, bucket, function) \
+                    == expected
+            assert raw.reads == []
+    rollup.flush()
+    assert rollup.aggregate('foo', t0, end, 3600, 'count') == \
+            [[t0, 361], [t0 + seconds(3600), 360]]
+    assert rollup.aggregate('foo', t0, end, 3600, 'first')[0][1] == 0
+    assert raw.reads != []
+
+
+def test_rollup_backend_get_picks_tier_by_limit():
+    raw = recording(CSVBackend())
+    rollup = RollupBackend(raw, [60, 3600])
+    t0 = now().replace(minute=0, second=0, microsecond=0) - seconds(7200)
+    rollup.set_many([('foo', t0 + seconds(i), i) for i in range(7200)])
+    assert rollup.get('foo', t0, t0 + seconds(7200), limit=2) == \
+            [[t0, 1799.5], [t0 + seconds(3600), 5399.5]]
+    assert len(rollup.get('foo', t0, t0 + seconds(7199), limit=100)) == 60
+    assert raw.reads == []
+    assert len(rollup.get('foo', t0, t0 + seconds(59), limit=10)) == 9
+    assert raw.reads == [('foo', t0, t0 + seconds(59))]
+
+
+def test_rollup_backend_reads_history_from_before_it_started():
+    raw = recording(CSVBackend())
+    t0 = now().replace(minute=0, second=0, microsecond=0) - seconds(3 * 3600)
+    raw.set_many([('foo', t0 + seconds(5 * i), i) for i in range(1440)])
+    rollup = RollupBackend(raw)  # as if restarted
+    end = t0 + seconds(7260)
+    counts = [[t0 + seconds(600 * i), 120] for i in range(12)]
+    assert rollup.aggregate('foo', t0, end, 600, 'count') == counts
+    assert len(rollup.get('foo', t0, end, limit=20)) == 20
+    rollup.set('foo', t0 + seconds(7230), 1440)
+    assert rollup.aggregate('foo', t0, end, 600, 'count') == \
+            counts + [[t0 + seconds(7200), 1]]
+    assert len(rollup.get('foo', t0, end, limit=20)) == 18
+    buckets = rollup.get('foo', t0, end, limit=121)  # minutely
+    assert buckets[0] == [t0, 5.5] and len(buckets) == 121
+    assert buckets[-1] == [t0 + seconds(7200), 1440]
+
+
+def test_csv_backend_range_reads_seek_through_sparse_index(tmpdir):
+    path = str(tmpdir) + '/'
+    backend = CSVBackend(path, index_every=10)
+    backend.metrics = Metrics()
+    scanned = lambda: backend.metrics.snapshot()['backends']['CSVBackend'][
+            'scanned']
+    t0 = datetime(2020, 1, 1)
+    backend.set_many([('foo', t0 + seconds(n), n) for n in range(1000)])
+    got = backend.get('foo', t0 + seconds(500), t0 + seconds(509))
+    assert [v for _, v in got] == range(500, 510)
+    assert scanned() == 11
+    backend.set('foo', t0 + seconds(505), -1)  # out of order
+    got = backend.get('foo', t0 + seconds(500), t0 + seconds(509))
+    assert [v for _, v in got] == range(500, 510) + [-1]
+    with open(path + 'foo.csv', 'a') as f:  # behind the index's back
+        f.write('%s,-2\n' % (t0 + seconds(506)).isoformat())
+    got = backend.get('foo', t0 + seconds(500), t0 + seconds(509))
+    assert [v for _, v in got] == range(500, 510) + [-1, -2]
+    backend.set('foo', t0 + seconds(2000), 2000)  # rebuilds the index
+    got = backend.get('foo', t0 + seconds(505), t0 + seconds(2000))
+    assert [v for _, v in got][-4:] == [999, -1, -2, 2000]
+    assert os.path.getsize(path + 'foo.csv.idx') == 16 * (2 + 101)
+    os.remove(path + 'foo.csv.idx')
+    assert backend.get('foo', t0 + seconds(998), t0 + seconds(999)) == \
+            [[t0 + seconds(998), 998], [t0 + seconds(999), 999]]
+
+
+def test_binary_backend_keeps_value_types(tmpdir):
+    path = str(tmpdir) + '/'
+    backend = BinaryBackend(path, enums=True)
+    backend.set_many([('big', t, 2 ** 40 + 1), ('flag', t, True),
+                      ('ratio', t, 0.1), ('state', t, 'idle'),
+                      ('state', t + seconds(1), 'busy'),
+                      ('state', t + seconds(2), 'idle')])
+    assert backend.get('big') == [[t, 2 ** 40 + 1]]
+    assert backend.get('flag')[0][1] is True
+    assert backend.get('ratio') == [[t, 0.1]]
+    assert [v for _, v in backend.get('state', t, t + seconds(2))] == \
+            ['idle', 'busy', 'idle']
+    assert len(open(path + 'state.ENUM').readlines()) == 2
+    assert os.path.getsize(path + 'state.VALUE') == 8 + 3 * 4
+    assert set(v for _, v in backend.aggregate('state', t, t + seconds(2),
+                                               10, 'max')) == set(['idle'])
+    with raises(BackendError):
+        backend.set('state', t, 3)
+    backend.set('flag', t + seconds(1), 7)
+    backend.set('flag', t + seconds(2), 0.5)
+    assert backend.get('flag', t, t + seconds(2)) == \
+            [[t, 1.0], [t + seconds(1), 7.0], [t + seconds(2), 0.5]]
+    assert os.path.getsize(path + 'flag.VALUE') == 8 + 3 * 8
+    with raises(BackendError):
+        BinaryBackend(path).set('text', t, 'idle')
+
+
+def test_binary_backend_caps_dictionaries_of_strings(tmpdir):
+    path = str(tmpdir) + '/'
+    backend = BinaryBackend(path, enums=True)
+    backend.set('load', t, '1.5')  # as the command line sends it
+    assert backend.get('load') == [[t, 1.5]]
+    assert [v for _, v in backend.aggregate('load', t, t, 10, 'sum')] == \
+            [1.5]
+    backend.max_codes = 3
+    other = BinaryBackend(path, enums=True)
+    for n, state in enumerate(['idle', 'busy', 'idle', 'down']):
+        (backend if n % 2 else other).set('state', t + seconds(n), state)
+    with raises(BackendError):
+        backend.set('state', t + seconds(4), 'gone')
+    assert [v for _, v in backend.get('state', t, t + seconds(4))] == \
+            ['idle', 'busy', 'idle', 'down']
+    assert len(open(path + 'state.ENUM').readlines()) == 3
+
+
+def test_binary_backend_reads_and_appends_headerless_float32(tmpdir):
+    path = str(tmpdir) + '/'
+    with open(path + 'old.TIME', 'wb') as f:
+        f.write(Struct('Q').pack(_to_ticks(t)))
+    with open(path + 'old.VALUE', 'wb') as f:
+        f.write(Struct('f').pack(0.5))
+    backend = BinaryBackend(path)
+    backend.set('old', t + seconds(1), 2 ** 40)
+    assert backend.get('old', t, t + seconds(1)) == \
+            [[t, 0.5], [t + seconds(1), float(2 ** 40)]]
+    assert os.path.getsize(path + 'old.VALUE') == 2 * 4
+    backend.set('old', t + seconds(2), 2 ** 40 + 1)  # no longer fits
+    assert [v for _, v in backend.get('old', t, t + seconds(2))] == \
+            [0.5, 2 ** 40, 2 ** 40 + 1]
+    assert os.path.getsize(path + 'old.VALUE') == 8 + 3 * 8
+
+
+def test_cached_backend_reads_only_new_points():
+    inner = recording(MemoryBackend(cache_seconds=10 ** 9))
+    backend = CachedBackend(inner)
+    backend.set_many([('foo', t + seconds(i), i) for i in range(10)])
+    get = lambda start, end: [v for _, v in backend.get(
+        'foo', t + seconds(start), t + seconds(end))]
+    assert get(0, 5) == [0, 1, 2, 3, 4, 5]
+    assert get(2, 8) == [2, 3, 4, 5, 6, 7, 8]
+    assert [r[1] > t + seconds(5) for r in inner.reads] == [False, True]
+    assert get(1, 8) == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert len(inner.reads) == 3
+    backend.set('foo', t + seconds(10), 10)  # in order: nothing to drop
+    assert get(1, 10) == [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert inner.reads[-1][1] > t + seconds(8)
+    backend.set('foo', t + seconds(4.5), 45)  # out of order
+    assert get(4, 10) == [4, 45, 5, 6, 7, 8, 9, 10]
+    assert inner.reads[-1][1:] == (t + seconds(4), t + seconds(10))
+    backend.clear()
+    assert get(4, 10) == []
+
+
+def test_cached_backend_aggregates_only_new_buckets():
+    inner = recording(MemoryBackend(cache_seconds=10 ** 9))
+    backend = CachedBackend(inner)
+    reference = MemoryBackend(cache_seconds=10 ** 9)
+    for b in backend, reference:
+        b.set_many([('foo', t + seconds(i), i) for i in range(100)])
+    windows = [(0, 40), (7, 52), (13, 58), (20, 70), (25, 80), (70, 90)]
+    for function in ['sum', 'count', 'first', 'last']:
+        for start, end in windows:
+            start, end = t + seconds(start), t + seconds(end)
+            reads = len(inner.reads)
+            cached = backend.aggregate('foo', start, end, 10, function)
+            assert cached == reference.aggregate('foo', start, end, 10,
+                                                 function)
+            if start != t:  # only the buckets at either end are read
+                for _, first, last in inner.reads[reads:]:
+                    assert last - first < seconds(25)
+
+
+def test_cached_backend_evicts_least_recently_used_results():
+    inner = recording(MemoryBackend(cache_seconds=10 ** 9))
+    backend = CachedBackend(inner, max_points=5)
+    backend.set_many([(s, t + seconds(i), i) for s in 'ab' for i in range(3)])
+    for signal in 'abab':
+        backend.get(signal, t, t + seconds(2))
+    assert [r[0] for r in inner.reads] == ['a', 'b', 'a', 'b']
+    assert backend.get('b', t, t + seconds(2)) == \
+            [[t + seconds(i), i] for i in range(3)]
+    assert len(inner.reads) == 4
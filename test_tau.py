@@ -1,6 +1,17 @@
-from datetime import datetime
+import os
+import sys
+import time
+import socket
+import multiprocessing
+import threading
+import subprocess
+from datetime import datetime, timedelta
 
-from tau import TauClient, TauProtocol
+from pytest import importorskip, raises
+
+from tau import Tau, TauClient, TauProtocol, TauServer, ServerBackend
+from tau import MemoryBackend, BinaryBackend, CSVBackend, ShardedBackend
+from tau import GlueBackend, RollupBackend, BackendError
 
 
 def pytest_funcarg__tau(request):
@@ -9,6 +20,56 @@ def pytest_funcarg__tau(request):
     return tau
 
 
+class SlowBackend(MemoryBackend):
+
+    delay = 0.05
+
+    def get(self, *arguments):
+        time.sleep(self.delay)
+        return MemoryBackend.get(self, *arguments)
+
+
+def free_port():
+    """A port that nothing listens on, for a server of a test."""
+    probe = socket.socket()
+    probe.bind(('localhost', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def serve(backend, port, **options):
+    server = TauServer(backend, port=port, **options)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def spawn(port, directory, *backends):
+    """Start `tau server` in another process, and wait for it to listen."""
+    tau = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tau.py')
+    command = [sys.executable, tau, 'server', '--port=%d' % port]
+    for backend in backends:
+        command.extend(['-b', backend])
+    process = subprocess.Popen(command, cwd=directory)
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server on port %d did not start' % port)
+
+
+def in_parallel(function, arguments):
+    threads = [threading.Thread(target=function, args=(a,))
+               for a in arguments]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+
+
 def test_set_get(tau):
     tau.set(foo=123)
     assert tau.get('foo') == 123
@@ -102,3 +163,469 @@ def test_server_failure_handling(tau):
     with TauProtocol() as protocol:
         protocol.send('die')
     assert tau.get('hai') == 'bye'
+
+
+def test_failed_set_keeps_the_connection(tmpdir):
+    backend = BinaryBackend(str(tmpdir) + '/')
+    port = free_port()
+    server = serve(backend, port)
+    try:
+        client = TauClient(port=port)
+        client.set(foo=1.5)
+        for _ in range(20):
+            client.set(bar='x')  # rejected by the backend, and only logged
+            assert client.get('foo') == 1.5
+    finally:
+        server.shutdown()
+
+
+def test_stale_pooled_connection_is_replaced():
+    port = free_port()
+    server = serve(MemoryBackend(), port)
+    try:
+        client = ServerBackend(port=port)
+        for command in [lambda: client.set('foo', datetime.now(), 1),
+                        lambda: client.get('foo')]:
+            ours, theirs = socket.socketpair()
+            theirs.close()  # hung up, but not noticed by the idle check
+            stale = TauProtocol(client=ours)
+            stale.idle = lambda: True
+            client._pool.put(stale)
+            command()
+            assert stale not in client._pool.queue
+        assert [v for _, v in client.get('foo')] == [1]
+    finally:
+        server.shutdown()
+
+
+def test_set_many(tau):
+    now = datetime.now()
+    tau.set_many([('a', now, 1), ('b', now, 2), ('a', now, 3)])
+    assert tau.get('a', 'b') == {'a': 3, 'b': 2}
+
+
+def test_connection_serves_many_commands(tau):
+    now = datetime.now()
+    with TauProtocol() as protocol:
+        protocol.send(['set_many', [['a', now, 1], ['b', now, 2]]])
+        protocol.send(['get', ['a', None, None, None]])
+        assert protocol.receive() == [[now, 1]]
+        protocol.send(['get', ['b', None, None, None]])
+        assert protocol.receive() == [[now, 2]]
+
+
+def test_pipeline(tau):
+    now = datetime.now()
+    backend = ServerBackend()
+    replies = backend.pipeline([('set', ['a', now, 1]),
+                                ('get', ['a', None, None, None]),
+                                ('set', ['b', now, 2]),
+                                ('signals', None)])
+    assert replies[0] == [[now, 1]]
+    assert sorted(replies[1]) == ['a', 'b']
+    backend.close()
+
+
+def test_server_throughput_scales_with_clients():
+    port = free_port()
+    server = serve(SlowBackend(), port, workers=8)
+
+    try:
+        backends = [ServerBackend(port=port) for _ in range(8)]
+        started = time.time()
+        in_parallel(lambda b: [b.get('foo') for _ in range(4)], backends)
+        # one at a time, the 32 gets would take 32 delays
+        assert time.time() - started < 16 * SlowBackend.delay
+    finally:
+        server.shutdown()
+
+
+def test_slow_reads_do_not_block_writes():
+    backend = SlowBackend()
+    backend.delay = 1
+    port = free_port()
+    server = serve(backend, port, workers=2)
+    try:
+        reader = threading.Thread(target=ServerBackend(port=port).get,
+                                  args=('foo',))
+        reader.start()
+        time.sleep(0.01)
+        writer = ServerBackend(port=port)
+        writer.set('bar', datetime.now(), 1)
+        assert writer.signals() == ['bar']
+        assert reader.is_alive()  # the write did not wait for the read
+        reader.join()
+    finally:
+        server.shutdown()
+
+
+def test_binary_and_json_protocols_agree(tau):
+    tau.set(f=0.5, i=2 ** 70, s=u'\u03c4', d={'a': [1, None, True]})
+    tau.set(f=1.5, i=-1, s='', d=[], t=datetime(2000, 1, 1))
+    binary = ServerBackend(binary=True)
+    json = ServerBackend(binary=False)
+    start, end = datetime.now() - timedelta(seconds=1), datetime.now()
+    for signal in ['f', 'i', 's', 'd', 't']:
+        assert binary.get(signal) == json.get(signal)
+        assert binary.get(signal, start, end) == json.get(signal, start, end)
+    assert [v for _, v in binary.get('f', start, end)] == [0.5, 1.5]
+    assert binary.get('i', start, end)[0][1] == 2 ** 70
+    assert binary.get('s')[0][1] == u''
+    assert json.get('t')[0][1] == datetime(2000, 1, 1)
+    assert binary._binary and not json._binary
+
+
+def test_get_arrays_over_the_binary_protocol():
+    importorskip('numpy')
+    port = free_port()
+    server = serve(MemoryBackend(), port)
+    try:
+        binary = ServerBackend(port=port, binary=True)
+        json = ServerBackend(port=port, binary=False)
+        start = datetime.now()
+        binary.set_many([('f', start + timedelta(seconds=n), n / 2.0)
+                         for n in range(5)] + [('i', start, 1)])
+        end = start + timedelta(seconds=10)
+        for signal in ['f', 'i', 'none']:
+            got, expected = (binary.get_arrays(signal, start, end),
+                             json.get_arrays(signal, start, end))
+            assert [list(a) for a in got] == [list(a) for a in expected]
+        ticks, values = binary.get_arrays('f', start, end)
+        assert list(values) == [0, 0.5, 1, 1.5, 2]
+        assert binary.get('f')[0][1] == 2  # points again
+    finally:
+        server.shutdown()
+
+
+def serve_one_command_per_connection(backend, port):
+    """Serve like the first servers did: JSON only, and no pipelining."""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', port))
+    server.listen(5)
+
+    def serve():
+        while True:
+            try:
+                client, _ = server.accept()
+            except socket.error:
+                return
+            with TauProtocol(client=client) as protocol:
+                message = ''
+                while not message.endswith('\n'):
+                    data = client.recv(4096)
+                    if not data:
+                        break
+                    message += data
+                if not message.endswith('\n'):
+                    continue
+                [[command, arguments]] = protocol.feed(message)
+                if command == 'get':
+                    protocol.send(backend.get(*arguments))
+                elif command == 'set':
+                    backend.set(*arguments)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test_client_falls_back_to_json_with_old_servers():
+    port = free_port()
+    server = serve_one_command_per_connection(MemoryBackend(), port)
+    try:
+        client = ServerBackend(port=port)
+        for n in range(50):  # each on a connection the server has not closed
+            client.set('foo', datetime.now(), n)
+            assert [v for _, v in client.get('foo')] == [n]
+        assert not client._binary
+    finally:
+        server.close()
+
+
+def test_slow_handshake_does_not_turn_off_the_binary_protocol():
+    silent = socket.socket()
+    silent.bind(('localhost', 0))
+    silent.listen(1)
+    try:
+        client = ServerBackend(port=silent.getsockname()[1])
+        with raises(socket.timeout):
+            client.signals()
+        assert client._binary
+    finally:
+        silent.close()
+
+
+def test_get_aggregate(tau):
+    for n in range(10):
+        tau.set(n=n)
+    assert max(tau.get('n', period=1, aggregate='max')) == 9
+    assert sum(tau.get('n', period=1, aggregate='count')) == 10
+    [[t, mean]] = tau.get('n', period=1, bucket=10 ** 9, aggregate='mean',
+                          timestamps=True)
+    assert type(t) == datetime and mean == 4.5
+
+
+def test_get_as_arrays():
+    importorskip('numpy')
+    tau = Tau(BinaryBackend())
+    tau.clear()
+    for n in range(10):
+        tau.set(a=n, b=-n)
+    ticks, values = tau.get('a', period=1, as_arrays=True)
+    assert list(values) == range(10)
+    assert list(ticks) == sorted(ticks)
+    got = tau.get('?', period=1, limit=5, as_arrays=True)
+    assert list(got['b'][1]) == [0, -3, -6, -9]
+    assert list(tau.get('a', as_arrays=True)[1]) == [9]
+    ticks, values = tau.get('a', period=1, aggregate='sum', as_arrays=True)
+    assert values.sum() == 45
+    tau.clear()
+    tau = Tau(BinaryBackend(enums=True))
+    tau.set(state='idle')
+    with raises(BackendError):  # not silently empty
+        tau.get('state', as_arrays=True)
+    tau.clear()
+
+
+def test_get_pattern_uses_fresh_signal_index():
+    tau = Tau(MemoryBackend())
+    tau.set({'host1.cpu': 1, 'host1.mem': 2, 'host2.cpu': 3, 'host10.cpu': 4})
+    assert tau.get('host1.*') == {'host1.cpu': 1, 'host1.mem': 2}
+    assert tau.get('*.cpu') == {'host1.cpu': 1, 'host2.cpu': 3,
+                                'host10.cpu': 4}
+    assert tau.get('host[12].cpu', 'host1?.cpu') == {'host1.cpu': 1,
+                                                     'host2.cpu': 3,
+                                                     'host10.cpu': 4}
+    tau.set({'host1.disk': 5})
+    assert tau.get('host1.*') == {'host1.cpu': 1, 'host1.mem': 2,
+                                  'host1.disk': 5}
+
+
+class ListingBackend(MemoryBackend):
+
+    listed = 0
+
+    def signals(self):
+        self.listed += 1
+        return MemoryBackend.signals(self)
+
+
+def test_signal_index_is_rebuilt_only_when_signals_change():
+    backend = ListingBackend()
+    tau = Tau(backend)
+    tau.set({'a.x': 1, 'a.y': 2})
+    for _ in range(3):
+        assert tau.get('a.*') == {'a.x': 1, 'a.y': 2}
+    tau.set({'a.x': 3})
+    assert tau.get('a.*') == {'a.x': 3, 'a.y': 2}
+    assert backend.listed == 1
+    tau.set({'a.z': 4})
+    assert tau.get('a.*') == {'a.x': 3, 'a.y': 2, 'a.z': 4}
+    assert backend.listed == 2
+
+
+def test_iter_range_streams_in_chunks():
+    backend = MemoryBackend(cache_seconds=None)
+    start = datetime.now()
+    backend.set_many([('n', start + timedelta(microseconds=i), i)
+                      for i in range(25000)])
+    port = free_port()
+    server = serve(backend, port)
+    try:
+        client = ServerBackend(port=port)
+        end = start + timedelta(seconds=1)
+        values = [v for _, v in client.iter_range('n', start, end)]
+        assert values == range(25000)
+        abandoned = client.iter_range('n', start, end)
+        next(abandoned)
+        abandoned.close()
+        assert client.get('n')[0][1] == 24999
+        tau = Tau(client)
+        assert list(tau.iter_range('n', start=start, end=end))[-1] == 24999
+    finally:
+        server.shutdown()
+
+
+class FailingBackend(MemoryBackend):
+
+    def iter_range(self, signal, start, end):
+        yield [start, 1]
+        raise BackendError('cannot read on')
+
+
+def test_iter_range_raises_errors_of_the_server():
+    port = free_port()
+    server = serve(FailingBackend(), port)
+    try:
+        client = ServerBackend(port=port)
+        points = client.iter_range('n', datetime.now(), datetime.now())
+        assert next(points)[1] == 1
+        with raises(BackendError):
+            next(points)
+        assert client.signals() == []  # the connection is still usable
+    finally:
+        server.shutdown()
+
+
+def test_server_metrics():
+    backend = BinaryBackend()
+    port = free_port()
+    server = serve(backend, port, profile_every=2)
+    try:
+        client = ServerBackend(port=port)
+        start = datetime.now()
+        client.set_many([('a', start + timedelta(microseconds=i), i)
+                         for i in range(10)])
+        client.get('a', start + timedelta(microseconds=2),
+                   start + timedelta(microseconds=5))
+        client.get('a')
+        stats = client.stats()
+        assert stats['commands']['set_many']['count'] == 1
+        get = stats['commands']['get']
+        assert get['count'] == 2 and get['errors'] == 0
+        assert sum(n for _, n in get['histogram']) == 2
+        assert get['bytes_out'] > 0 and stats['bytes_in'] > 0
+        assert stats['backends'] == {'BinaryBackend': {'reads': 1,
+                                                       'scanned': 4,
+                                                       'returned': 4}}
+        [profile] = stats['profiles']
+        assert profile['command'] == 'get' and 'function calls' in \
+                profile['report']
+    finally:
+        server.shutdown()
+        backend.clear()
+
+
+def test_server_instruments_wrapped_backends():
+    tier = MemoryBackend()
+    rollup = RollupBackend(MemoryBackend(), {60: tier})
+    server = TauServer(GlueBackend(rollup, rollup), port=0)
+    other = TauServer(tier, port=0)
+    try:
+        assert tier.metrics is server.metrics
+    finally:
+        server.shutdown()
+        other.shutdown()
+        server.server.close()
+        other.server.close()
+    assert tier.metrics is None
+
+
+def test_server_caches_sliding_window_queries():
+    port = free_port()
+    server = serve(MemoryBackend(), port, cache_points=1000)
+    try:
+        tau = Tau(ServerBackend(port=port))
+        for i in range(5):
+            tau.set(foo=i)
+        assert tau.get('foo', period=5) == [0, 1, 2, 3, 4]
+        tau.set(foo=5)
+        assert tau.get('foo', period=5) == [0, 1, 2, 3, 4, 5]
+        cached = server.metrics.snapshot()['backends']['CachedBackend']
+        assert cached == {'reads': 2, 'scanned': 6, 'returned': 11}
+    finally:
+        server.shutdown()
+
+
+def test_sharded_backend_over_server_processes(tmpdir):
+    ports = [free_port() for _ in range(3)]
+    processes = [spawn(port, str(tmpdir.mkdir(str(port))), 'csv')
+                 for port in ports]
+    try:
+        shards = [ServerBackend(port=port) for port in ports]
+        router = ShardedBackend(*shards[:2])
+        start = datetime.now()
+        names = ['s%d' % i for i in range(60)]
+        router.set_many([(name, start + timedelta(microseconds=n), n)
+                         for name in names for n in range(3)])
+        on = [set(shard.signals()) for shard in shards]
+        assert on[0] and on[1] and not on[2] and not on[0] & on[1]
+        tau = Tau(router)
+        assert tau.get('s*') == dict((name, 2) for name in names)
+        router.add_shard(shards[2])
+        moved = set(shards[2].signals())
+        assert 0 < len(moved) < 40
+        end = start + timedelta(seconds=1)
+        for name in names:
+            shard = shards[2] if name in moved else shards[int(name in on[1])]
+            assert router._shard(name) is shard
+            assert [v for _, v in router.get(name, start, end)] == [0, 1, 2]
+        router.set('s0', datetime.now(), 3)
+        assert tau.get('s0') == 3
+        assert tau.get('s*') == dict((name, 3 if name == 's0' else 2)
+                                     for name in names)
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+
+def test_sharded_backend_over_local_file_shards(tmpdir):
+    # more shards than the shared pool has threads, each fanning out on it
+    shards = [CSVBackend(str(tmpdir.mkdir(str(i))) + '/')
+              for i in range(2 * multiprocessing.cpu_count() + 1)]
+    router = ShardedBackend(*shards)
+    names = ['s%d' % i for i in range(20 * len(shards))]
+    router.set_many([(name, datetime.now(), 1) for name in names])
+    got = {}
+    thread = threading.Thread(target=lambda: got.update(Tau(router).get('s*')))
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert got == dict((name, 1) for name in names)
+
+
+def test_sharded_backend_adds_shards_twice(tmpdir):
+    shards = [CSVBackend(str(tmpdir.mkdir(str(i))) + '/') for i in range(4)]
+    router = ShardedBackend(*shards[:2])
+    start = datetime.now()
+    names = ['s%d' % i for i in range(200)]
+    router.set_many([(name, start, 1) for name in names])
+    router.add_shard(shards[2])
+    router.set_many([(name, start + timedelta(seconds=1), 2)
+                     for name in names])
+    router.add_shard(shards[3])  # not from stale copies left on shards[:2]
+    end = start + timedelta(seconds=2)
+    for name in names:
+        assert [v for _, v in router.get(name, start, end)] == [1, 2]
+    memory = ShardedBackend(MemoryBackend(), MemoryBackend())
+    memory.set_many([(name, datetime.now(), 1) for name in names])
+    memory.add_shard(MemoryBackend())
+    assert Tau(memory).get('s*') == dict((name, 1) for name in names)
+
+
+def test_subscribe_pushes_coalesced_updates():
+    port = free_port()
+    server = serve(MemoryBackend(), port)
+    try:
+        client = ServerBackend(port=port)
+        client.set('cpu.a', datetime.now(), 1)
+        updates = Tau(client).subscribe('cpu.*', max_rate=5)
+        assert next(updates) == {'cpu.a': 1}
+        for n in range(10):
+            client.set_many([('cpu.b', datetime.now(), n),
+                             ('mem', datetime.now(), n)])
+        pushed = [next(updates)]
+        while pushed[-1] != {'cpu.b': 9}:
+            pushed.append(next(updates))
+        assert len(pushed) < 10  # coalesced, with no `mem` in them
+        client.set('cpu.a', datetime.now(), 2)
+        assert next(updates) == {'cpu.a': 2}
+        watchers = [Tau(ServerBackend(port=port)).subscribe('idle.*')
+                    for _ in range(50)]
+        assert [next(w) for w in watchers] == [{}] * 50
+        client.set('idle.x', datetime.now(), 3)
+        client.set('cpu.a', datetime.now(), 3)
+        assert [next(w) for w in watchers] == [{'idle.x': 3}] * 50
+        assert next(updates) == {'cpu.a': 3}
+        [w.close() for w in watchers]
+        updates.close()
+        client.set('idle.x', datetime.now(), 4)  # to hung up connections
+        updates = Tau(client).subscribe('cpu.*', max_rate=5)
+        assert next(updates) == {'cpu.a': 3, 'cpu.b': 9}
+        client.set('cpu.a', datetime.now(), 4)
+        assert next(updates) == {'cpu.a': 4}
+    finally:
+        server.shutdown()